@@ -3,6 +3,53 @@ import psycopg2
 from html import escape
 import datetime
 import configparser, os
+import tempfile
+import sys
+import json
+import sqlite3
+import hashlib
+import argparse
+import re
+import gzip
+import shutil
+from xml.sax.saxutils import quoteattr
+import multiprocessing
+from itertools import repeat, groupby
+from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from contextlib import contextmanager
+from tagurit_core import ItemWriter
+try:
+    import zstandard
+except ImportError:
+    zstandard = None    # gzip variants only
+
+OUTPUT = "/usr/local/www/data/bookmarks.html"
+'''the page written when ~/.tagurit.ini has no [makebookmarks] outputs'''
+
+FRAGMENTS = os.path.join(
+        os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+        'makebookmarks', 'fragments.sqlite')
+'''rendered html of each item, keyed by iid and a hash of the row'''
+
+WRITE_BUFFER = 1 << 16
+
+BATCH_SIZE = 2000
+'''rows fetched from the server side cursor at a time'''
+
+COMPRESS_BUFFER = 1 << 20
+
+COMPRESSED = ('.gz', '.zst')
+'''suffixes of the precompressed copies a web server can send as they are,
+e.g. with nginx's gzip_static and zstd_static'''
+
+WORD = re.compile(r'\w+')
+
+SHARD_CHUNK = 16
+'''shards handed to a worker process at a time'''
+
+ROW_HASH = """md5(concat_ws(chr(31),title,url,notes,tags))"""
+'''sql for a hash of the rendered columns of a row'''
 
 def format_rfc1123(x):
     '''format datetime x, assumed to be in gmt, as an rfc 1123 timestamp'''
@@ -15,7 +62,476 @@ def format_rfc1123(x):
     S = x.second
     return "{0:3s}, {1:02d} {2:3s} {3:04d} {4:02d}:{5:02d}:{6:02d} GMT".format(w,d,m,y,H,M,S)
 
-html='''<!doctype html>
+@contextmanager
+def staged_open(path, binary=False):
+    '''open a temporary file beside path for writing and yield it and its
+    name; once the block ends it is complete, on disk and readable, ready
+    for publish_files to rename over path, and on error it is removed'''
+    directory = os.path.dirname(path)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix="." + os.path.basename(path) + ".")
+    try:
+        with open(fd, "wb" if binary else "w", encoding=None if binary else "utf_8",
+                  buffering=WRITE_BUFFER) as fh:
+            yield fh, tmp
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.chmod(tmp, 0o644)    # mkstemp makes it private, the web server must read it
+    except:
+        os.unlink(tmp)
+        raise
+
+def discard_files(pairs):
+    '''remove the temporary files of (temporary, path) pairs never published'''
+    for tmp, path in pairs:
+        if tmp is not None and os.path.exists(tmp):
+            os.unlink(tmp)
+
+def publish_files(pairs):
+    '''rename each (temporary, path) pair over path in order, or remove path
+    where the temporary is None, and make the renames durable; a page goes
+    last, after the copies made from it, so it is never newer than they are'''
+    done = 0
+    try:
+        for tmp, path in pairs:
+            if tmp is not None:
+                os.replace(tmp, path)
+            elif os.path.exists(path):
+                os.unlink(path)     # it would be stale
+            done += 1
+    except:
+        discard_files(pairs[done:])
+        raise
+    for directory in {os.path.dirname(x) for _, x in pairs}:
+        dirfd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(dirfd)
+        finally:
+            os.close(dirfd)
+
+@contextmanager
+def atomic_open(path, binary=False):
+    '''open a temporary file beside path for writing, and rename it over path
+    once it is complete and on disk, so readers never see a partial file'''
+    with staged_open(path, binary) as (fh, tmp):
+        yield fh
+    publish_files([(tmp, path)])
+
+def compress(source, path, suffix):
+    '''write a .gz or .zst copy of source, the finished temporary file of path,
+    with the same mtime; return the (temporary, path+suffix) to publish'''
+    if suffix == '.zst' and zstandard is None:
+        return None, path + suffix
+    with open(source, 'rb') as src, staged_open(path + suffix, binary=True) as (dst, tmp):
+        if suffix == '.gz':
+            # mtime=0 so the same page always compresses to the same bytes
+            out = gzip.GzipFile(filename='', mode='wb', fileobj=dst, compresslevel=9, mtime=0)
+        else:
+            out = zstandard.ZstdCompressor(level=19).stream_writer(dst, closefd=False)
+        with out:
+            shutil.copyfileobj(src, out, COMPRESS_BUFFER)
+    try:
+        st = os.stat(source)
+        os.utime(tmp, ns=(st.st_atime_ns, st.st_mtime_ns))
+    except:
+        os.unlink(tmp)
+        raise
+    return tmp, path + suffix
+
+def write_etag(source, path):
+    '''write a strong ETag of source, the finished temporary file of path;
+    return the (temporary, path.etag) to publish'''
+    digest = hashlib.sha256()
+    with open(source, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(COMPRESS_BUFFER), b''):
+            digest.update(chunk)
+    with staged_open(path + '.etag') as (fh, tmp):
+        fh.write('"{0}"\n'.format(digest.hexdigest()[:32]))
+    return tmp, path + '.etag'
+
+def read_etag(path):
+    with open(path + '.etag', encoding="utf_8") as fh:
+        return fh.read().strip()
+
+def make_sidecars(pool, source, path):
+    '''start compressing and hashing source, the finished temporary file of
+    path, in pool; return the futures'''
+    return [pool.submit(compress, source, path, x) for x in COMPRESSED] \
+            + [pool.submit(write_etag, source, path)]
+
+def gather_sidecars(futures):
+    '''wait for the futures of make_sidecars and return their (temporary, path)
+    pairs; if any failed, remove the others' temporaries and raise its error'''
+    pairs, error = list(), None
+    for job in futures:
+        try:
+            pairs.append(job.result())
+        except Exception as e:
+            error = error or e
+    if error is not None:
+        discard_files(pairs)
+        raise error
+    return pairs
+
+def render_item(iid,title,url,notes,tags):
+    '''return the html of one item'''
+    title = escape(title)
+    tooltip = escape(tags.strip())
+    if notes != "":
+       tooltip = escape(notes) + "\n" + tooltip
+    return '''<span id="i{3}" class="item"><a href="{1}" title="{2}" target="_blank">{0}</a>, </span>\n'''.format(title,url,tooltip,iid)
+
+def item_words(title,notes,tags):
+    '''return the words the page's regex filter can match in an item, space separated'''
+    return " ".join(sorted(set(WORD.findall(" ".join((title,notes,tags)).lower()))))
+
+def open_spool():
+    '''return the path of, and a connection to, a new sqlite file beside the
+    fragment cache, for what an output would otherwise hold in memory'''
+    fd, spool = tempfile.mkstemp(dir=os.path.dirname(FRAGMENTS), suffix=".sqlite")
+    os.close(fd)
+    return spool, sqlite3.connect(spool)
+
+def remove_spool(spool, db):
+    db.close()
+    if os.path.exists(spool):
+        os.unlink(spool)
+
+def write_ids(fh, rows):
+    '''write the ids of (id,) rows to fh as the items of a json list'''
+    for n, (iid,) in enumerate(rows):
+        fh.write("," + str(iid) if n else str(iid))
+
+def write_groups(fh, rows):
+    '''write (key, id) rows, sorted by key, to fh as a json object of id lists'''
+    fh.write("{")
+    for n, (key, group) in enumerate(groupby(rows, key=itemgetter(0))):
+        # </ would end the script element early
+        fh.write(("," if n else "") + json.dumps(key).replace("</", "<\\/") + ":[")
+        write_ids(fh, ((iid,) for _, iid in group))
+        fh.write("]")
+    fh.write("}")
+
+def read_manifest(path):
+    try:
+        with open(path, encoding="utf_8") as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return {}
+
+def open_fragments(path, renderer):
+    '''open the fragment cache, emptying it if the page was rendered by another renderer'''
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    db = sqlite3.connect(path)
+    db.execute("""CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);""")
+    if dict(db.execute("""SELECT key,value FROM meta;""")).get('renderer') != renderer:
+        db.execute("""DROP TABLE IF EXISTS fragments;""")
+        db.execute("""INSERT OR REPLACE INTO meta VALUES ('renderer',?);""", (renderer,))
+    # tags and words are space separated, for the page's index
+    db.execute("""CREATE TABLE IF NOT EXISTS fragments
+                  (iid INTEGER PRIMARY KEY, hash TEXT, html TEXT, tags TEXT, words TEXT);""")
+    # the items of this run, the rest are forgotten by prune_fragments
+    db.execute("""CREATE TEMP TABLE seen (iid INTEGER PRIMARY KEY);""")
+    return db
+
+def fragment(fragments, iid,rowhash,title,url,notes,tags):
+    '''return the html, tags and words of an item from the fragment cache,
+    rendering it if it changed, and whether it was rendered'''
+    cached = fragments.execute(
+            """SELECT hash,html,tags,words FROM fragments WHERE iid = ?;""", (iid,)).fetchone()
+    if cached and cached[0] == rowhash:
+        return cached[1], cached[2], cached[3], False
+    item = render_item(iid,title,url,notes,tags)
+    itemtags, words = tags.strip(), item_words(title,notes,tags)
+    fragments.execute("""INSERT OR REPLACE INTO fragments VALUES (?,?,?,?,?);""",
+            (iid,rowhash,item,itemtags,words))
+    return item, itemtags, words, True
+
+def prune_fragments(fragments):
+    '''forget items deleted since the last run'''
+    fragments.execute("""DELETE FROM fragments WHERE iid NOT IN (SELECT iid FROM seen);""")
+    fragments.commit()
+
+class Output:
+    '''one export format, written to a temporary file as batches of
+    (iid,hash,title,url,notes,tags) rows arrive, finished by close and
+    renamed into place by publish'''
+
+    rendered = 0
+    '''items rendered afresh rather than taken from the fragment cache'''
+
+    def __init__(self, path):
+        self.path = path
+        self.file = staged_open(path)
+        self.fh, self.tmp = self.file.__enter__()
+
+    def write(self, rows):
+        pass
+
+    def finish(self):
+        pass
+
+    def close(self):
+        '''complete the temporary file, self.tmp, for make_sidecars'''
+        try:
+            self.finish()
+        except:
+            self.abort()
+            raise
+        file, self.file = self.file, None
+        file.__exit__(None, None, None)
+
+    def publish(self, sidecars):
+        '''rename sidecars, the (temporary, path) pairs made from the
+        complete file, into place and then the file itself'''
+        publish_files(sidecars + [(self.tmp, self.path)])
+
+    def abort(self):
+        '''remove the temporary file, leaving the last published one'''
+        if self.file is None:
+            discard_files([(self.tmp, self.path)])
+            return
+        file, self.file = self.file, None
+        try:
+            raise RuntimeError("export abandoned")
+        except RuntimeError as e:
+            file.__exit__(type(e), e, e.__traceback__)
+
+class HtmlOutput(Output):
+    '''the filterable page, items from the fragment cache and the index at the end'''
+
+    def __init__(self, path, fragments):
+        Output.__init__(self, path)
+        self.fragments = fragments
+        # the filter's index of ids, in page order, by tag and by word,
+        # is spooled to disk and grouped by finish
+        self.spool, self.db = open_spool()
+        self.db.execute("""CREATE TABLE ids (iid INTEGER);""")
+        self.db.execute("""CREATE TABLE tags (tag TEXT, iid INTEGER);""")
+        self.db.execute("""CREATE TABLE tokens (word TEXT, iid INTEGER);""")
+        self.fh.write(html)
+
+    def write(self, rows):
+        tags = list()
+        tokens = list()
+        for row in rows:
+            item, itemtags, words, rendered = fragment(self.fragments, *row)
+            self.rendered += rendered
+            self.fh.write(item)
+            iid = row[0]
+            tags.extend((tag, iid) for tag in itemtags.split())
+            tokens.extend((word, iid) for word in words.split())
+        self.db.executemany("""INSERT INTO ids VALUES (?);""", ((x[0],) for x in rows))
+        self.db.executemany("""INSERT INTO tags VALUES (?,?);""", tags)
+        self.db.executemany("""INSERT INTO tokens VALUES (?,?);""", tokens)
+        self.fragments.executemany("""INSERT OR IGNORE INTO seen VALUES (?);""", ((x[0],) for x in rows))
+
+    def finish(self):
+        self.db.execute("""CREATE INDEX tags_tag ON tags (tag);""")
+        self.db.execute("""CREATE INDEX tokens_word ON tokens (word);""")
+        self.fh.write('''    </div>
+    <script type="application/json" id="index">''')
+        self.fh.write('{"ids":[')
+        write_ids(self.fh, self.db.execute("""SELECT iid FROM ids ORDER BY rowid;"""))
+        self.fh.write('],"tags":')
+        write_groups(self.fh, self.db.execute("""SELECT tag,iid FROM tags ORDER BY tag,rowid;"""))
+        self.fh.write(',"tokens":')
+        write_groups(self.fh, self.db.execute("""SELECT word,iid FROM tokens ORDER BY word,rowid;"""))
+        self.fh.write('}')
+        self.fh.write("</script>\n")
+        self.fh.write(tail)
+
+    def close(self):
+        try:
+            Output.close(self)
+        finally:
+            remove_spool(self.spool, self.db)
+
+    def abort(self):
+        remove_spool(self.spool, self.db)
+        Output.abort(self)
+
+class ItemsOutput(Output):
+    '''an export in one of the formats tagurit itself imports and exports,
+    written by tagurit_core's ItemWriter'''
+
+    format = None
+
+    def __init__(self, path):
+        Output.__init__(self, path)
+        self.items = ItemWriter(self.fh, self.format)
+
+    def write(self, rows):
+        self.items.write(row[2:] for row in rows)
+
+    def finish(self):
+        self.items.finish()
+
+class NetscapeOutput(ItemsOutput):
+    '''a Netscape bookmark file, as browsers import and export'''
+
+    format = 'html'
+
+class JsonOutput(ItemsOutput):
+    '''a json list of items, one per line'''
+
+    format = 'json'
+
+class CsvOutput(ItemsOutput):
+    '''a csv dump with a title,url,notes,tags header'''
+
+    format = 'csv'
+
+class OpmlOutput(Output):
+    '''an opml 2.0 outline of links, tags as categories'''
+
+    def __init__(self, path):
+        Output.__init__(self, path)
+        self.fh.write('''<?xml version="1.0" encoding="UTF-8"?>
+<opml version="2.0">
+  <head>
+    <title>Bookmarks</title>
+    <dateCreated>{0}</dateCreated>
+  </head>
+  <body>
+'''.format(format_rfc1123(datetime.datetime.utcnow())))
+
+    def write(self, rows):
+        for iid,rowhash,title,url,notes,tags in rows:
+            self.fh.write('''    <outline type="link" text={0} url={1} category={2}{3}/>\n'''.format(
+                    quoteattr(title), quoteattr(url),
+                    quoteattr(",".join("/" + x for x in tags.split())),
+                    " description=" + quoteattr(notes) if notes != "" else ""))
+
+    def finish(self):
+        self.fh.write("  </body>\n</opml>\n")
+
+def shard_file(key):
+    '''return the path, relative to the site, of shard key, letter:a or tag:name'''
+    kind, _, name = key.partition(":")
+    if kind == "tag":
+        # tags may hold any character, so their files are named by a hash
+        name = hashlib.sha1(name.encode()).hexdigest()[:16]
+    return "{0}/{1}.html".format(kind, name)
+
+def first_letter(title):
+    '''return the letter shard of an item, _ for titles not starting with a-z or 0-9'''
+    first = title.lstrip()[:1].lower()
+    return first if first.isascii() and first.isalnum() else "_"
+
+def render_shard(spool, directory, key, previous):
+    '''write the items of shard key from spool into directory, unless their
+    hash is previous and the file is there; return key and [file,count,hash]'''
+    db = sqlite3.connect(spool)
+    try:
+        items = [x for x, in db.execute("""SELECT html FROM members JOIN items USING (ord)
+                                           WHERE shard = ? ORDER BY ord;""", (key,))]
+    finally:
+        db.close()
+    content = "".join(items)
+    digest = hashlib.sha256(content.encode()).hexdigest()[:16]
+    name = shard_file(key)
+    path = os.path.join(directory, name)
+    if digest != previous or not os.path.exists(path):
+        with staged_open(path) as (fh, tmp):
+            fh.write(content)
+        sidecars = list()
+        try:
+            for suffix in COMPRESSED:
+                sidecars.append(compress(tmp, path, suffix))
+        except:
+            discard_files(sidecars + [(tmp, path)])
+            raise
+        publish_files(sidecars + [(tmp, path)])
+    return key, [name, len(items), digest]
+
+class SiteOutput:
+    '''a small landing page, index.html in directory path, and the items in
+    shards by tag and by first letter, which its script fetches when a filter
+    wants them; close rewrites only the shards that changed and publish
+    drops those no longer wanted, once the page no longer refers to them'''
+
+    rendered = 0
+
+    def __init__(self, path, fragments):
+        self.directory = path
+        self.path = os.path.join(path, "index.html")
+        self.tmp = None
+        self.record = os.path.join(path, "shards.json")
+        self.fragments = fragments
+        for kind in ("letter", "tag"):
+            os.makedirs(os.path.join(path, kind), exist_ok=True)
+        # the shards' items are spooled to disk, for the worker processes
+        self.spool, self.db = open_spool()
+        self.db.execute("""CREATE TABLE items (ord INTEGER PRIMARY KEY, html TEXT);""")
+        self.db.execute("""CREATE TABLE members (shard TEXT, ord INTEGER);""")
+        self.count = 0
+
+    def write(self, rows):
+        items = list()
+        members = list()
+        for row in rows:
+            item, itemtags, words, rendered = fragment(self.fragments, *row)
+            self.rendered += rendered
+            self.count += 1
+            items.append((self.count, item))
+            members.append(("letter:" + first_letter(row[2]), self.count))
+            members.extend(("tag:" + tag, self.count) for tag in itemtags.split())
+        self.db.executemany("""INSERT INTO items VALUES (?,?);""", items)
+        self.db.executemany("""INSERT INTO members VALUES (?,?);""", members)
+        self.fragments.executemany("""INSERT OR IGNORE INTO seen VALUES (?);""", ((x[0],) for x in rows))
+
+    def close(self):
+        try:
+            self.db.execute("""CREATE INDEX members_shard ON members (shard, ord);""")
+            self.db.commit()
+            keys = [x for x, in self.db.execute("""SELECT DISTINCT shard FROM members;""")]
+            self.previous = previous = read_manifest(self.record)
+            # forkserver rather than fork, threads may be compressing other outputs
+            with ProcessPoolExecutor(mp_context=multiprocessing.get_context("forkserver")) as pool:
+                self.shards = shards = dict(pool.map(render_shard, repeat(self.spool), repeat(self.directory),
+                        keys, [previous.get(x, [None])[-1] for x in keys], chunksize=SHARD_CHUNK))
+            letters = sorted(x.partition(":")[2] for x in shards if x.startswith("letter:"))
+            with staged_open(self.path) as (fh, self.tmp):
+                fh.write(site_html)
+                fh.write("    <nav>{0}</nav>\n".format(" ".join(
+                        '<a href="#{0}">{0}</a>'.format(x) for x in letters)))
+                fh.write('''    <div id="items"></div>
+    <script type="application/json" id="shards">''')
+                fh.write(json.dumps(shards, separators=(',',':')).replace("</", "<\\/"))
+                fh.write("</script>\n")
+                fh.write(tail)
+        finally:
+            remove_spool(self.spool, self.db)
+
+    def publish(self, sidecars):
+        publish_files(sidecars + [(self.tmp, self.path)])
+        with atomic_open(self.record) as fh:
+            json.dump(self.shards, fh, separators=(',',':'))
+        for key in set(self.previous) - set(self.shards):
+            for suffix in ("",) + COMPRESSED:
+                try:
+                    os.unlink(os.path.join(self.directory, self.previous[key][0] + suffix))
+                except FileNotFoundError:
+                    pass
+
+    def abort(self):
+        '''remove the spool and any unpublished page, leaving the shards and
+        page last published'''
+        remove_spool(self.spool, self.db)
+        if self.tmp is not None:
+            discard_files([(self.tmp, self.path)])
+
+OUTPUTS = dict(html=HtmlOutput, netscape=NetscapeOutput, json=JsonOutput, csv=CsvOutput,
+        opml=OpmlOutput, site=SiteOutput)
+
+def output_spec(spec):
+    '''parse a FORMAT=PATH argument'''
+    fmt, sep, path = spec.partition("=")
+    if fmt not in OUTPUTS or not sep or not path:
+        raise argparse.ArgumentTypeError("expected one of {0}=PATH".format(",".join(OUTPUTS)))
+    return fmt, os.path.abspath(path)
+
+head='''<!doctype html>
 <!-- generated {0} by makebookmarks.py -->
 <html lang="en">
   <head>
@@ -25,37 +541,81 @@ html='''<!doctype html>
         datetime.date.today().isoformat(),
         format_rfc1123(datetime.datetime.utcnow()+datetime.timedelta(days=1)))
 
-html += '''
+html = head + r'''
     <title>Bookmarks</title>
-    <script src="https://ajax.googleapis.com/ajax/libs/jquery/1.11.1/jquery.min.js"></script>
     <script>
-      $( document ).ready(function() {
-          // register a callback for tags or regex boxes changing
-          $( "#tags, #regex" ).on("change",function() {
-            selector = ".item";
-            $( selector ).hide();
-            tags = $( "#tags" ).val().trim()
-            if (tags.length > 0) {
-              selector += "[tags~='" + tags.split(/\s+/).join("'][tags~='") + "']"
+      // the page ends with an index of item ids by tag and by word, so a
+      // filter is a few list intersections and only items whose visibility
+      // changes are touched
+      document.addEventListener("DOMContentLoaded", function() {
+          var index = JSON.parse(document.getElementById("index").textContent);
+          var tagsBox = document.getElementById("tags");
+          var regexBox = document.getElementById("regex");
+          var shown = new Set();
+
+          function item(id) {
+            return document.getElementById("i" + id);
+          }
+
+          function keep(ids, wanted) {
+            return ids.filter(function (id) { return wanted.has(id); });
+          }
+
+          // ids of items with a word containing the literal word
+          function containing(word) {
+            var ids = new Set();
+            word = word.toLowerCase();
+            for (var token in index.tokens) {
+              if (token.indexOf(word) != -1) {
+                index.tokens[token].forEach(function (id) { ids.add(id); });
+              }
             }
-            tagged = $( selector );
+            return ids;
+          }
 
-            re = $( "#regex" ).val();
-            if (re == "") {
-              tagged.show()
+          function filter() {
+            var ids = index.ids;
+            var tags = tagsBox.value.trim();
+            if (tags.length > 0) {
+              tags.split(/\s+/).forEach(function (tag) {
+                ids = keep(ids, new Set(index.tags[tag] || []));
+              });
             }
-            else
-            {
-              re = new RegExp(re,"i");
-              tagged.each(function () {
-                if ($( this ).text().search(re) != -1 || $( this).attr("title").search(re) != -1) {
-                  $( this ).show()
-                }
+
+            var re = regexBox.value;
+            if (re != "") {
+              if (/^\w+$/.test(re)) {
+                ids = keep(ids, containing(re));
+              }
+              try {
+                re = new RegExp(re, "i");
+              } catch (e) {
+                return;
+              }
+              ids = ids.filter(function (id) {
+                var e = item(id);
+                return e.textContent.search(re) != -1 || e.firstChild.title.search(re) != -1;
               });
             }
-          });
 
-          $("#tags").trigger("change")
+            var visible = new Set(ids);
+            shown.forEach(function (id) {
+              if (!visible.has(id)) {
+                item(id).style.display = "";
+              }
+            });
+            visible.forEach(function (id) {
+              if (!shown.has(id)) {
+                item(id).style.display = "inline";
+              }
+            });
+            shown = visible;
+          }
+
+          // register a callback for tags or regex boxes changing
+          tagsBox.addEventListener("change", filter);
+          regexBox.addEventListener("change", filter);
+          filter();
       });
     </script>
     <style>
@@ -71,30 +631,216 @@ html += '''
       <br>
 '''
 
-config = configparser.ConfigParser()
-config.read([os.path.expanduser('~/.tagurit.ini'), os.path.expanduser('~/.database.ini')])
-conn = psycopg2.connect(
-        database='tagurit',
-        host=config['tagurit']['host'],
-        user=config['tagurit']['user'],
-        password=config['tagurit']['password'])
-cur = conn.cursor()
-cur.execute("""SELECT title,url,notes,tags FROM items ORDER BY lower(title);""")
-
-for row in cur:
-    title,url,notes,tags = row
-    title = escape(title)
-    tooltip = escape(tags.strip())
-    if notes != "":
-       tooltip = escape(notes) + "\n" + tooltip
-    html += '''<span tags="{3}" class="item"><a href="{1}" title="{2}" target="_blank">{0}</a>, </span>\n'''.format(title,url,tooltip,tags)
+site_html = head + r'''
+    <title>Bookmarks</title>
+    <script>
+      // the items are in shards by tag and by first letter, listed at the
+      // end of the page with their sizes; a filter fetches the smallest shard
+      // that holds every match, or every letter for a regex alone
+      document.addEventListener("DOMContentLoaded", function() {
+          var shards = JSON.parse(document.getElementById("shards").textContent);
+          var tagsBox = document.getElementById("tags");
+          var regexBox = document.getElementById("regex");
+          var items = document.getElementById("items");
+          var loaded = {};
+          var latest = 0;
 
-html += '''
-    </div>
+          function load(shard) {
+            if (!(shard[0] in loaded)) {
+              // the hash changes with the content, so it is cached for good
+              loaded[shard[0]] = fetch(shard[0] + "?v=" + shard[2]).then(function (response) {
+                if (!response.ok) {
+                  delete loaded[shard[0]];
+                  throw new Error(response.statusText);
+                }
+                return response.text();
+              });
+            }
+            return loaded[shard[0]];
+          }
+
+          // the tooltip's last line is the item's tags
+          function itemTags(e) {
+            return e.firstChild.title.split("\n").pop().split(" ");
+          }
+
+          function filter() {
+            var tags = tagsBox.value.trim();
+            tags = tags.length > 0 ? tags.split(/\s+/) : [];
+            var letter = location.hash.slice(1);
+            var re = regexBox.value;
+            if (re != "") {
+              try {
+                re = new RegExp(re, "i");
+              } catch (e) {
+                return;
+              }
+            }
+
+            var wanted = [];
+            if (tags.length > 0) {
+              var smallest = null;
+              tags.forEach(function (tag) {
+                var shard = shards["tag:" + tag];
+                if (!shard) {
+                  smallest = [];    // no item has the tag
+                } else if (smallest === null || (smallest.length > 0 && shard[1] < smallest[1])) {
+                  smallest = shard;
+                }
+              });
+              if (smallest.length > 0) {
+                wanted.push(smallest);
+              }
+            } else if (("letter:" + letter) in shards) {
+              wanted.push(shards["letter:" + letter]);
+            } else if (re != "") {
+              for (var key in shards) {
+                if (key.indexOf("letter:") == 0) {
+                  wanted.push(shards[key]);
+                }
+              }
+              wanted.sort(function (a, b) { return a[0] < b[0] ? -1 : 1; });
+            }
+
+            // a filter started later may finish first
+            var mine = ++latest;
+            Promise.all(wanted.map(load)).then(function (texts) {
+              if (mine != latest) {
+                return;
+              }
+              items.innerHTML = texts.join("");
+              Array.prototype.slice.call(items.children).forEach(function (e) {
+                var has = itemTags(e);
+                if (!tags.every(function (tag) { return has.indexOf(tag) != -1; })
+                    || (re != "" && e.textContent.search(re) == -1
+                        && e.firstChild.title.search(re) == -1)) {
+                  items.removeChild(e);
+                }
+              });
+            });
+          }
+
+          // register a callback for tags or regex boxes changing
+          tagsBox.addEventListener("change", filter);
+          regexBox.addEventListener("change", filter);
+          // picking a letter shows it unfiltered by tags
+          window.addEventListener("hashchange", function () {
+            tagsBox.value = "";
+            filter();
+          });
+          filter();
+      });
+    </script>
+  </head>
+  <body>
+    <input id="tags" placeholder="Tags" value="fave"/>
+    <input id="regex" placeholder="Regex" />
+'''
+
+tail = '''
   </body>
 </html>
 '''
 
-fh = open("/usr/local/www/data/bookmarks.html","w",encoding="utf_8")
-fh.write(html)
-fh.close()
+def main(argv):
+    parser = argparse.ArgumentParser(description="Write the bookmarks page from the tagurit database.")
+    parser.add_argument('-f', '--force', action='store_true', help="regenerate even if nothing changed")
+    parser.add_argument('-o', '--output', action='append', type=output_spec, metavar='FORMAT=PATH',
+            help="write FORMAT ({0}) to PATH, instead of the outputs in ~/.tagurit.ini".format(
+                    ", ".join(OUTPUTS)))
+    args = parser.parse_args(argv)
+
+    config = configparser.ConfigParser()
+    config.read([os.path.expanduser('~/.tagurit.ini'), os.path.expanduser('~/.database.ini')])
+    conn = psycopg2.connect(
+            database='tagurit',
+            host=config['tagurit']['host'],
+            user=config['tagurit']['user'],
+            password=config['tagurit']['password'])
+    # every query below sees the same snapshot of the table
+    conn.set_session(isolation_level='REPEATABLE READ', readonly=True)
+
+    # e.g. [makebookmarks] html = /usr/local/www/data/bookmarks.html, json = ...
+    outputs = args.output
+    if not outputs and config.has_section('makebookmarks'):
+        outputs = [(fmt, os.path.abspath(os.path.expanduser(path)))
+                for fmt, path in config.items('makebookmarks') if fmt in OUTPUTS]
+    outputs = sorted(outputs or [('html', OUTPUT)], key=lambda x: x[0] != 'html')
+    # what the last run generated from, to skip runs when nothing changed
+    manifest = outputs[0][1] + ".manifest"
+
+    # the outputs depend on the rows, on this script, and on the date via expires
+    with open(__file__, 'rb') as fh:
+        renderer = hashlib.sha256(fh.read()).hexdigest()
+    cur = conn.cursor()
+    cur.execute("""SELECT count(*),md5(string_agg(iid || ':' || """ + ROW_HASH + """,',' ORDER BY iid))
+                   FROM items;""")
+    count, checksum = cur.fetchone()
+    version = hashlib.sha256("{0} {1} {2} {3} {4}".format(
+            renderer, datetime.date.today().isoformat(), count, checksum, outputs).encode()).hexdigest()
+    if not args.force and all(os.path.exists(os.path.join(path, "index.html") if fmt == 'site' else path)
+                              for fmt, path in outputs) \
+            and read_manifest(manifest).get('version') == version:
+        return 0    # unchanged since the last run
+
+    # only the page and the site render items, and mark them seen; pruning
+    # after a run without them would empty the cache
+    fragments = None
+    if any(fmt in ('html', 'site') for fmt, path in outputs):
+        fragments = open_fragments(FRAGMENTS, renderer)
+    writers = list()
+    try:
+        for fmt, path in outputs:
+            if fmt in ('html', 'site'):
+                writers.append(OUTPUTS[fmt](path, fragments))
+            else:
+                writers.append(OUTPUTS[fmt](path))
+        # one pass over the table, a batch at a time, feeds every output
+        cur = conn.cursor(name='makebookmarks')
+        cur.itersize = BATCH_SIZE
+        cur.execute("""SELECT iid,""" + ROW_HASH + """,title,url,notes,tags FROM items
+                       ORDER BY lower(title);""")
+        while True:
+            rows = cur.fetchmany(BATCH_SIZE)
+            for writer in writers:
+                writer.write(rows)
+            if len(rows) < BATCH_SIZE:
+                break
+        conn.close()
+        if fragments:
+            prune_fragments(fragments)
+
+        # zlib, zstd and sha256 release the GIL, so each output is compressed and
+        # hashed while the rest, the page and its index last, are finished
+        rendered = sum(x.rendered for x in writers)
+        etags = dict()
+        with ThreadPoolExecutor() as pool:
+            jobs = list()
+            try:
+                for writer in reversed(writers):
+                    writer.close()
+                    jobs.append((writer, make_sidecars(pool, writer.tmp, writer.path)))
+                while jobs:
+                    writer, futures = jobs[0]
+                    writer.publish(gather_sidecars(futures))
+                    writers.remove(writer)
+                    jobs.pop(0)
+                    etags[writer.path] = read_etag(writer.path)
+            finally:
+                for writer, futures in jobs:    # drop what was made for the unpublished
+                    for job in futures:
+                        if job.exception() is None:
+                            discard_files([job.result()])
+    finally:
+        for writer in writers:  # only those not yet published
+            writer.abort()
+    if fragments:
+        fragments.close()
+
+    with atomic_open(manifest) as fh:
+        json.dump(dict(version=version, items=count, checksum=checksum, rendered=rendered,
+                etags=etags, generated=datetime.datetime.utcnow().isoformat() + 'Z'), fh, indent=1)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -1,19 +1,84 @@
 #!/usr/bin/env python3
 import re
+import time
 import psycopg2
 import psycopg2.extensions
 import webbrowser
-import configparser, os
-import gi
-gi.require_version('Gtk', '3.0')
-from gi.repository import Gtk #, Gdk, GdkPixbuf, GLib
-from urllib.parse import urlparse
+import os
+import sqlite3
+import sys
+import argparse
+import threading
+from tagurit_core import (LOAD_BATCH_SIZE, SNAPSHOT_PATH, DELTA_OVERLAP, PAGE_SIZE,
+        unescape, guess_title, read_config, connect_args, canonical_url, ItemModel,
+        ensure_delta_schema, ensure_search_schema, open_snapshot, write_snapshot,
+        WriteBehind, Instruments, read_items, write_items, import_items)
+
+FILTER_DEBOUNCE_MS = 250
+'''Quiet time after a keystroke before a live filter pass starts.'''
+
+FILTER_SLICE_SECONDS = 0.01
+'''How long a filter pass may hold the main loop per idle callback.'''
+
+TRACE_ENV = 'TAGURIT_TRACE'
+'''Environment variable naming a file to write a Chrome trace to on exit.'''
+
+FORMATS = {'.html': 'html', '.htm': 'html', '.json': 'json', '.csv': 'csv'}
+
+def guess_format(path, fmt):
+    if fmt:
+        return fmt
+    fmt = FORMATS.get(os.path.splitext(path)[1].lower())
+    if not fmt:
+        sys.exit("can't tell the format of {0}, use --format".format(path))
+    return fmt
+
+def cli(argv):
+    '''Bulk import or export items without the GUI.'''
+    parser = argparse.ArgumentParser(prog='tagurit.py',
+            description='Tag URIs. With no arguments, opens the TagURIt window.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    p = commands.add_parser('import', help='add bookmarks from files, skipping stored urls')
+    p.add_argument('-f', '--format', choices=sorted(set(FORMATS.values())))
+    p.add_argument('-n', '--dry-run', action='store_true', help="count but don't store")
+    p.add_argument('files', nargs='+')
+    p = commands.add_parser('export', help='write every item to a file')
+    p.add_argument('-f', '--format', choices=sorted(set(FORMATS.values())))
+    p.add_argument('file', nargs='?', default='-', help='defaults to stdout, as csv')
+    args = parser.parse_args(argv)
+
+    config = read_config()
+    conn = psycopg2.connect(**connect_args(config))
+    if args.command == 'import':
+        records = list()
+        for path in args.files:
+            fmt = guess_format(path, args.format)
+            with open(path, newline='', encoding='utf_8') as fh:
+                records += read_items(fh, fmt)
+        added, skipped = import_items(conn, records,
+                config['tagurit'].getboolean('strip_tracking', fallback=False),
+                args.dry_run)
+        print("{0} items added, {1} already stored".format(added, skipped))
+    else:
+        fmt = 'csv' if args.file == '-' and not args.format else guess_format(args.file, args.format)
+        cur = conn.cursor(name='tagurit_export')
+        cur.itersize = LOAD_BATCH_SIZE
+        cur.execute("""SELECT title,url,notes,tags FROM items ORDER BY lower(title);""")
+        if args.file == '-':
+            write_items(sys.stdout, fmt, cur)
+        else:
+            with open(args.file, 'w', newline='', encoding='utf_8') as fh:
+                write_items(fh, fmt, cur)
+    conn.close()
+    return 0
 
-def escape(s):
-    return s.replace('&','&amp;').replace('<','&lt;').replace('>','&gt;')
+if __name__ == '__main__' and len(sys.argv) > 1:
+    sys.exit(cli(sys.argv[1:]))
 
-def unescape(s):
-    return s.replace('&lt;','<').replace('&gt;','>').replace('&amp;','&')
+# everything below needs a display
+import gi
+gi.require_version('Gtk', '3.0')
+from gi.repository import Gtk, GLib #, Gdk, GdkPixbuf
 
 class TagURIt(Gtk.Window):
     def __init__(self):
@@ -21,48 +86,86 @@ class TagURIt(Gtk.Window):
 
         self.set_default_size(300, 400)
 
-        self.visible_tagset = None
-        '''A item is visible when its tags match all of these.'''
+        config = read_config()
 
-        self.regex = None
-        '''A item is visible if title or url match this regex.'''
+        self.model = ItemModel(
+                config['tagurit'].getboolean('strip_tracking', fallback=False))
+        '''The rows, their indexes and the filter state, see ItemModel.'''
 
-        self.visible_item_count = 0
-        '''Count of visible items'''
+        self.trace_path = os.environ.get(TRACE_ENV)
+        self.instruments = Instruments(trace=bool(self.trace_path))
+        '''Timings of the query, load, filter and write phases.'''
 
-        self.urlstore = Gtk.ListStore(int,str,str,str,str)
+        self.debug = config['tagurit'].getboolean('debug', fallback=False)
+        '''Show the last operation's timings on the status line.'''
+
+        self.load_started = None
+        self.filter_started = None
+        '''perf_counter when the load or filter pass in progress began.'''
+
+        self.filter_timeout = None
+        self.filter_pass = None
+        self.filter_row = 0
+        '''GLib sources and next urlstore row of a pending live filter.'''
+
+        # iid,title,url,notes,tags,slot,visible
+        self.urlstore = Gtk.ListStore(int,str,str,str,str,int,bool)
         self.filtered_urlstore = self.urlstore.filter_new()
-        self.filtered_urlstore.set_visible_func(self.is_item_visible)
+        # a column rather than a visible func, so Gtk filters without
+        # calling back into python for every row
+        self.filtered_urlstore.set_visible_column(6)
+        self.iter_by_slot = dict()
+        '''slot -> urlstore iter, ListStore iters persist'''
 
-        self.known_tagset = set()
-        '''Complete set of known tags.'''
+        self.tag_store = TagStore()
+        '''Tags with usage counts for TagsDialog, built once and kept up to date.'''
 
-        config = configparser.ConfigParser()
-        config.read([os.path.expanduser('~/.tagurit.ini'), os.path.expanduser('~/.database.ini')])
-        self.conn = psycopg2.connect(
-                database='tagurit',
-                host=config['tagurit']['host'],
-                user=config['tagurit']['user'],
-                password=config['tagurit']['password'])
-        self.conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        self.loading = False
+        self.updated_hwm = '-infinity'
+        self.deleted_hwm = 0
+        '''Server high-water marks the loaded rows are current to.'''
 
-        cur = self.conn.cursor()
+        # read the local snapshot, if any, before touching the network
+        self.snapshot_path = os.path.expanduser(
+                config['tagurit'].get('snapshot', SNAPSHOT_PATH))
+        snapshot = open_snapshot(self.snapshot_path)
 
-        cur.execute("""SELECT iid,title,url,notes,tags FROM items ORDER BY title;""")
-        for row in cur:
-            iid,title,url,notes,tags = row
-            #tooltips use pango markup so you must escape &, <, >, etc
-            notes = escape(notes)
-            # tags in database are surrounded by spaces for easy sql matching
-            tags = tags.strip()
-            self.urlstore.append((iid,title,url,notes,tags))
-            self.known_tagset.update({x for x in tags.split()})
+        self.db = db = connect_args(config)
+        self.conn = None
+        '''Autocommit connection, None until go_online connects, or if offline.'''
+
+        self.delta_sync = False
+        '''Whether the server tracks changes, so the snapshot can be brought up to date.'''
+
+        self.server_filter = config['tagurit'].getboolean('server_filter', fallback=False)
+        '''Filter in SQL and hold only one page of rows, for huge collections.
+
+        Turned off again if the server's schema can't be brought up to date.'''
+
+        self.page_size = config['tagurit'].getint('page_size', fallback=PAGE_SIZE)
+        self.page = 0
+        self.page_total = None
+        self.server_query = (frozenset(), '')
+        '''Page shown, rows matching, None until counted, and (tagset,pattern)
+        filter in server_filter mode.'''
+
+        self.page_starts = [None]
+        '''(title,iid) each page visited so far starts after, for keyset paging.'''
+
+        self.writer = WriteBehind(lambda: psycopg2.connect(**db),
+                GLib.idle_add,self.on_write_inserted,self.on_write_failed,
+                instruments=self.instruments)
+        '''Worker applying Sync and Delete to the database.'''
+
+        self.live_filter = config['tagurit'].getboolean('live_filter', fallback=True)
+        '''Filter as you type rather than on Enter.'''
 
         vbox = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=6)
         self.add(vbox)
 
-        # selected item id value
+        # selected item id value and urlstore slot
         self.iid = None
+        self.slot = None
 
         # title entry line
         self.title_entry = Gtk.Entry()
@@ -106,6 +209,7 @@ class TagURIt(Gtk.Window):
         hbox.pack_start(button, False, False, 0)
         hbox.pack_start(self.tags_entry, True, True, 0)
         vbox.pack_start(hbox, False, False, 0)
+        self.attach_tag_completion(self.tags_entry)
 
         # buttons 
         hbox = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=6)
@@ -143,18 +247,21 @@ class TagURIt(Gtk.Window):
         self.filter_entry.set_icon_from_icon_name(Gtk.EntryIconPosition.SECONDARY,"edit-clear")
         self.filter_entry.connect("icon_press",self.on_clear_filter_icon_clicked)
         self.filter_entry.connect("activate",self.on_filter_activate)
+        self.filter_entry.connect("changed",self.on_filter_changed)
         hbox = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=6)
         button = Gtk.Button.new_with_label("Tags")
         button.connect("clicked",self.on_filter_clicked)
         hbox.pack_start(button, False, False, 0)
         hbox.pack_start(self.filter_entry, True, True, 0)
         vbox.pack_start(hbox, False, False, 0)
+        self.attach_tag_completion(self.filter_entry)
 
         # pattern entry line
         self.regex_entry = Gtk.Entry()
         self.regex_entry.set_icon_from_icon_name(Gtk.EntryIconPosition.SECONDARY,"edit-clear")
         self.regex_entry.connect("icon_press",self.on_clear_filter_icon_clicked)
         self.regex_entry.connect("activate",self.on_regex_activate)
+        self.regex_entry.connect("changed",self.on_filter_changed)
         hbox = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=6)
         hbox.pack_start(Gtk.Label.new("Regex"), False, False, 0)
         hbox.pack_start(self.regex_entry, True, True, 0)
@@ -163,23 +270,315 @@ class TagURIt(Gtk.Window):
         # seperator
         vbox.pack_start(Gtk.HSeparator(), False, False, 0)
 
-        # status line
+        # status line, with paging in server_filter mode
+        hbox = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=6)
+        self.prev_button = Gtk.Button.new_from_icon_name("go-previous",Gtk.IconSize.BUTTON)
+        self.prev_button.connect("clicked",self.on_page_clicked,-1)
+        hbox.pack_start(self.prev_button, False, False, 0)
         self.status = Gtk.Label.new("")
-        vbox.pack_start(self.status, False, False, 3)
+        hbox.pack_start(self.status, True, True, 0)
+        self.next_button = Gtk.Button.new_from_icon_name("go-next",Gtk.IconSize.BUTTON)
+        self.next_button.connect("clicked",self.on_page_clicked,1)
+        hbox.pack_start(self.next_button, False, False, 0)
+        for button in (self.prev_button, self.next_button):
+            button.set_no_show_all(not self.server_filter)
+        vbox.pack_start(hbox, False, False, 3)
+
+        self.connect("delete-event",self.on_window_delete)
+
+        if snapshot and not self.server_filter:
+            cur, self.updated_hwm, self.deleted_hwm = snapshot
+            self.start_load(cur,lambda: self.go_online(self.on_snapshot_online))
+        else:
+            self.set_status("Connecting...")
+            self.go_online(self.on_server_online)
+
+    def go_online(self,then):
+        '''Connect on a worker, so a slow or unreachable server holds nothing
+        up, then call then on the main loop once connected.'''
+        threading.Thread(target=self.connect_worker,args=(then,),daemon=True).start()
+
+    def connect_worker(self,then):
+        try:
+            conn = psycopg2.connect(**self.db)
+            conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            delta_sync = ensure_delta_schema(conn)
+            server_filter = self.server_filter and ensure_search_schema(conn)
+        except psycopg2.Error as e:
+            GLib.idle_add(self.on_offline,str(e).strip())
+            return
+        GLib.idle_add(self.on_online,conn,delta_sync,server_filter,then)
+
+    def on_online(self,conn,delta_sync,server_filter,then):
+        self.conn = conn
+        self.delta_sync = delta_sync
+        if not server_filter:
+            self.local_filter()
+        then()
+        return False
+
+    def on_offline(self,error):
+        '''Keep the snapshot rows, if any, when the server can't be reached.'''
+        self.local_filter()
+        self.set_status("Offline, {0} items from the snapshot: {1}".format(len(self.model),error))
+        return False
+
+    def local_filter(self):
+        '''Filter the rows held here, server_filter or not.'''
+        if self.server_filter:
+            self.server_filter = False
+            self.prev_button.hide()
+            self.next_button.hide()
+
+    def on_server_online(self):
+        '''Fill the urlstore from the server, there being no snapshot to start from.'''
+        if self.server_filter:
+            cur = self.conn.cursor()
+            with self.instruments.phase('query'):
+                cur.execute("""SELECT DISTINCT unnest(string_to_array(btrim(tags),' ')) FROM items;""")
+            self.learn_tags(x for (x,) in cur if x)
+            self.query_page()
+        else:
+            self.start_server_load()
 
-    def is_same_url(self,model,path,treeiter,url):
-        '''Compare one urlstore row's url to url.'''
-        if model[treeiter][2] == url or model[treeiter][2].strip('/') == url or model[treeiter][2] == url.strip('/'):
-            self.dup = True
-        return self.dup
+    def on_snapshot_online(self):
+        '''Bring the snapshot rows up to date, or replace them if that can't be done.'''
+        if self.delta_sync:
+            self.sync_delta()
+        else:
+            self.clear_rows()
+            self.start_server_load()
+
+    def start_server_load(self):
+        '''Stream every row from the server into the urlstore.'''
+        # a named cursor inside a transaction streams rows as they are
+        # fetched, rather than the server materializing the whole result
+        # first as a withhold cursor under autocommit would; repeatable
+        # read has the high-water marks match the rows
+        conn = psycopg2.connect(**self.db)
+        conn.set_session(isolation_level='REPEATABLE READ',readonly=True)
+        if self.delta_sync:
+            self.mark_high_water(conn.cursor())
+        cur = conn.cursor(name='tagurit_load')
+        cur.itersize = LOAD_BATCH_SIZE
+        with self.instruments.phase('query'):
+            cur.execute("""SELECT iid,title,url,notes,tags FROM items ORDER BY title;""")
+        self.start_load(cur,conn.close)
+
+    def start_load(self,cur,done=None):
+        '''Stream rows from cur into the urlstore in the background.
+
+        cur may be a server-side psycopg2 cursor or a snapshot cursor;
+        done is called once every row is in.'''
+        self.loading = True
+        self.load_started = time.perf_counter()
+        self.set_status("Loading...")
+        GLib.idle_add(self.load_batch,cur,done)
+
+    def load_batch(self,cur,done):
+        with self.instruments.phase('fetch'):
+            rows = cur.fetchmany(LOAD_BATCH_SIZE)
+        self.add_rows(rows)
+        if len(rows) < LOAD_BATCH_SIZE:
+            cur.close()
+            self.loading = False
+            self.instruments.record('load',self.load_started,time.perf_counter())
+            self.set_status("{0} items loaded".format(len(self.model)))
+            if done:
+                done()
+            return False
+        self.set_status("Loading... {0} items".format(len(self.model)))
+        return True
+
+    def mark_high_water(self,cur):
+        '''Note how far the server's change tracking has got.'''
+        cur.execute("""SELECT coalesce(max(updated_at)::text,'-infinity'),
+                              (SELECT coalesce(max(did),0) FROM deleted_items)
+                       FROM items;""")
+        self.updated_hwm, self.deleted_hwm = cur.fetchone()
+
+    def sync_delta(self):
+        '''Apply rows changed or deleted on the server since the snapshot.'''
+        cur = self.conn.cursor()
+        updated_hwm, deleted_hwm = self.updated_hwm, self.deleted_hwm
+        with self.instruments.phase('query'):
+            self.mark_high_water(cur)
+            cur.execute("""SELECT iid,title,url,notes,tags FROM items
+                           WHERE updated_at > %s::timestamptz - %s::interval
+                           ORDER BY title;""",
+                    (updated_hwm,DELTA_OVERLAP))
+            changed = cur.fetchall()
+            cur.execute("""SELECT iid FROM deleted_items WHERE did > %s;""",(deleted_hwm,))
+            deleted = [x for (x,) in cur]
+        treeiters = self.iter_by_slot
+        new = list()
+        for iid,title,url,notes,tags in changed:
+            slot = self.model.slot_by_iid.get(iid)
+            if slot is None:
+                new.append((iid,title,url,notes,tags))
+            else:
+                self.update_row(treeiters[slot],title,url,notes,tags)
+        self.add_rows(new)
+        for iid in deleted:
+            if iid in self.model.slot_by_iid:
+                self.remove_row(treeiters[self.model.slot_by_iid[iid]])
+        self.set_status("{0} items, {1} changed and {2} deleted since last run".format(
+                len(self.model),len(changed),len(deleted)))
+
+    def query_page(self):
+        '''Replace the urlstore with one page of rows filtered by the server.'''
+        if self.conn is None:
+            return  # on_server_online queries once connected
+        tagset, pattern = self.server_query
+        where, args = ["""tag_keys @> %s::text[]"""], [sorted(tagset)]
+        if pattern:
+            where.append("""(title ~* %s OR url ~* %s OR notes ~* %s)""")
+            args += [pattern] * 3
+        # pages start after the last row of the one before, so a deep page
+        # costs no more than the first as OFFSET would
+        page_where, page_args = list(where), list(args)
+        start = self.page_starts[self.page]
+        if start:
+            page_where.append("""(title,iid) > (%s,%s)""")
+            page_args += list(start)
+        cur = self.conn.cursor()
+        self.instruments.begin()
+        try:
+            with self.instruments.phase('query'):
+                if self.page_total is None:     # only once per filter
+                    cur.execute("""SELECT count(*) FROM items WHERE """ + " AND ".join(where) + ";",args)
+                    self.page_total = cur.fetchone()[0]
+                cur.execute("""SELECT iid,title,url,notes,tags FROM items WHERE """ +
+                        " AND ".join(page_where) + """ ORDER BY title,iid LIMIT %s;""",
+                        page_args + [self.page_size])
+                rows = cur.fetchall()
+        except psycopg2.Error as e:
+            self.set_status("Query failed: {0}".format(str(e).strip()))
+            return
+        del self.page_starts[self.page + 1:]
+        if rows:
+            self.page_starts.append((rows[-1][1],rows[-1][0]))
+        self.clear_rows()
+        self.add_rows(rows)
+        first = self.page * self.page_size
+        self.prev_button.set_sensitive(self.page > 0)
+        self.next_button.set_sensitive(len(rows) == self.page_size
+                and first + len(rows) < self.page_total)
+        self.set_status("Items {0}-{1} of {2}".format(
+                min(first + 1,self.page_total),first + len(self.model),self.page_total))
+
+    def on_page_clicked(self,button,step):
+        self.page += step
+        self.query_page()
+
+    def clear_rows(self):
+        '''Empty the urlstore and the indexes, reusing slots if no write needs them.'''
+        self.urlstore.clear()
+        self.iter_by_slot.clear()
+        reuse = self.writer.idle()
+        if reuse:
+            self.writer.forget_slots()
+        self.model.clear(reuse)
+
+    def on_window_delete(self,widget,event):
+        '''Flush pending writes and save the snapshot for next time.'''
+        self.writer.close()
+        if self.trace_path:
+            try:
+                self.instruments.write_trace(self.trace_path)
+            except OSError as e:
+                print("can't write trace {0}: {1}".format(self.trace_path,e))
+        if self.debug:
+            print("\n".join(self.instruments.summary()))
+        # rows still without an iid will come back in the next delta
+        if self.delta_sync and not self.loading and not self.server_filter:
+            try:
+                write_snapshot(self.snapshot_path,
+                        ((r[0],r[1],r[2],unescape(r[3]),r[4]) for r in self.urlstore if r[0]),
+                        self.updated_hwm,self.deleted_hwm)
+            except (OSError, sqlite3.Error) as e:
+                print("can't save snapshot {0}: {1}".format(self.snapshot_path,e))
+        return False
+
+    def add_rows(self,rows):
+        '''Append database rows to the urlstore and index them.'''
+        # index before appending so the filter sees the rows on row-inserted
+        with self.instruments.phase('index',rows=len(rows)):
+            items = self.model.add_rows(rows)
+        is_visible = self.model.is_visible
+        with self.instruments.phase('liststore',rows=len(items)):
+            for item in items:
+                self.iter_by_slot[item[5]] = self.urlstore.append(item + (is_visible(item[5]),))
+        return [x[5] for x in items]
+
+    def add_row(self,iid,title,url,notes,tags):
+        '''Append one database row to the urlstore, index it and return its slot.'''
+        return self.add_rows(((iid,title,url,notes,tags),))[0]
+
+    def row_values(self,treeiter):
+        '''Return a urlstore row as (iid,title,url,notes,tags) in database form.'''
+        iid,title,url,notes,tags = self.urlstore.get(treeiter,0,1,2,3,4)
+        return (iid,title,url,unescape(notes),' ' + tags + ' ')
+
+    def on_write_inserted(self,inserted):
+        '''Fill in the iids of rows whose queued insert was written.'''
+        treeiters = self.iter_by_slot
+        for slot,iid in inserted:
+            if slot in treeiters:   # unless deleted meanwhile
+                self.urlstore.set_value(treeiters[slot],0,iid)
+                self.model.set_iid(slot,iid)
+                if self.get_slot() == slot:
+                    self.set_iid(iid)
+
+    def on_write_failed(self,ops,error):
+        '''Undo the optimistic model changes of a batch the database rejected.'''
+        for op in reversed(ops):
+            treeiter = self.iter_by_slot.get(op.slot)
+            if op.kind == 'delete':
+                self.add_row(op.iid or op.undo[0],*op.undo[1:])
+            elif treeiter is None:
+                continue    # gone since
+            elif op.kind == 'insert':
+                self.remove_row(treeiter)
+            else:
+                self.update_row(treeiter,*op.undo[1:])
+        self.set_status("Write failed and was undone: {0}".format(error))
+
+    def update_row(self,treeiter,title,url,notes,tags):
+        '''Change a urlstore row in place and reindex it.'''
+        # index first so the filter sees the new tags on row-changed
+        slot = self.urlstore[treeiter][5]
+        values = self.model.update_row(slot,title,url,notes,tags)
+        # set every column at once so the row is re-evaluated only once
+        self.urlstore.set(treeiter,[1,2,3,4,6],list(values) + [self.model.is_visible(slot)])
+
+    def remove_row(self,treeiter):
+        '''Remove a urlstore row and drop it from the indexes.'''
+        iid, slot = self.urlstore[treeiter][0], self.urlstore[treeiter][5]
+        self.model.remove_row(slot,iid)
+        # keep a filter pass in progress from skipping the row after it
+        if self.filter_pass and self.urlstore.get_path(treeiter).get_indices()[0] < self.filter_row:
+            self.filter_row -= 1
+        del self.iter_by_slot[slot]
+        self.urlstore.remove(treeiter)
 
     def is_duplicate_url(self,url):
-        '''Return True iff url is already in the urlstore.'''
-        self.dup = False
-        self.urlstore.foreach(self.is_same_url,url)
-        return self.dup
+        '''Return True iff url is already stored.'''
+        if self.model.is_duplicate_url(url):
+            return True
+        # with only one page, or only the rows streamed in so far, ask the server
+        if self.conn and (self.server_filter or self.loading):
+            cur = self.conn.cursor()
+            canonical = canonical_url(url,self.model.url_index.strip_tracking)
+            cur.execute("""SELECT EXISTS (SELECT 1 FROM items
+                           WHERE rtrim(url,'/') IN (rtrim(%s,'/'),rtrim(%s,'/')));""",
+                    (url,canonical))
+            return cur.fetchone()[0]
+        return False
 
     def set_status(self,msg):
+        if self.debug and self.instruments.last:
+            msg = "{0} [{1}]".format(msg,self.instruments.describe_last()).strip()
         self.status.set_text(msg)
 
     def get_iid(self):
@@ -188,6 +587,12 @@ class TagURIt(Gtk.Window):
     def set_iid(self,iid):
         self.iid = iid
 
+    def get_slot(self):
+        return self.slot
+
+    def set_slot(self,slot):
+        self.slot = slot
+
     def get_title(self):
         return self.title_entry.get_text().strip()
 
@@ -219,6 +624,7 @@ class TagURIt(Gtk.Window):
 
     def clear_data(self):
         self.set_iid(None)
+        self.set_slot(None)
         self.set_title("")
         self.set_url("")
         self.set_notes("")
@@ -231,6 +637,7 @@ class TagURIt(Gtk.Window):
         if treeiter != None:
             row = model[treeiter]
             self.set_iid(model[treeiter][0])
+            self.set_slot(model[treeiter][5])
             self.set_title(model[treeiter][1])
             self.set_url(model[treeiter][2])
             self.set_notes(model[treeiter][3])
@@ -249,56 +656,69 @@ class TagURIt(Gtk.Window):
         webbrowser.open_new(self.url_entry.get_text())
 
     def on_sync_clicked(self,button):
+        self.instruments.begin()
+        with self.instruments.phase('sync'):
+            status = self.sync_item()
+        self.set_status(status)
+
+    def sync_item(self):
+        '''Store the edited item in the model now and in the database in the background.
+
+        Returns the message for the status line.'''
         iid = self.get_iid()
         title = self.get_title()
         url = self.get_url().rstrip('/')
         notes = self.get_notes()
-        tags = self.get_tags()
-        tags = self.fix_plural_tags(tags)
-        self.known_tagset.update(tags.split())  #in case we entered any novel tags
+        tags, suggestions = self.normalize_tags(self.get_tags())
+        self.learn_tags(tags.split())  #in case we entered any novel tags
         # tags in database are surrounded by spaces for easy sql matching
-        tags = ' ' + self.fix_plural_tags(tags) + ' '
+        tags = ' ' + tags + ' '
         if not title or not url:
-            self.set_status("Both Title and URL must be set")
-            return
+            return "Both Title and URL must be set"
         print((iid,title,url,notes,tags))   #FIXME: debug
-        cur = self.conn.cursor()
-        if iid: # it already exists in the database
+        # the model is updated now, the database by self.writer in the background
+        if self.get_slot() is not None: # it already exists, if only in the queue
             sel = self.item_tree.get_selection()
             model, treeiter = sel.get_selected()
             assert model and treeiter
-            model.set_value(treeiter,1,title)
-            model.set_value(treeiter,2,url)
-            #tooltips use pango markup so you must escape &, <, >, etc(?)
-            model.set_value(treeiter,3,escape(notes))
-            model.set_value(treeiter,4,tags)
-            cur.execute(
-                    """UPDATE items
-                       SET title = %s,url = %s,notes = %s,tags = %s
-                       WHERE iid = %s;""",
-                    (title,url,notes,tags,iid))
+            treeiter = model.convert_iter_to_child_iter(treeiter)
+            undo = self.row_values(treeiter)
+            self.update_row(treeiter,title,url,notes,tags)
+            self.writer.put('update',self.get_slot(),iid,(title,url,notes,tags),undo)
             sel.unselect_all()
         else:
             if self.is_duplicate_url(url):
-                self.set_status("That url is already stored")
-                return
+                return "That url is already stored"
             else:
-                # tags in database are surrounded by spaces for easy sql matching
-                cur.execute(
-                        """INSERT INTO items (title,url,notes,tags) VALUES
-                        (%s,%s,%s,%s) RETURNING iid,title,url,notes,tags;""",
-                        (title,url,notes,tags))
-                self.urlstore.append(cur.fetchone())
+                similar = self.model.url_index.find_near(url)
+                slot = self.add_row(0,title,url,notes,tags)
+                self.writer.put('insert',slot,0,(title,url,notes,tags))
+                if similar:
+                    suggestions = "; ".join(x for x in (
+                        "Stored, but similar to " + " ".join(similar),suggestions) if x)
         self.clear_data()
+        return suggestions
 
-    def on_tags_clicked(self,button):
-        tags = self.fix_plural_tags(self.get_tags())
-        dialog = TagsDialog(self, self.known_tagset, tags)
+    def run_tags_dialog(self,tags,counts):
+        '''Run a TagsDialog over the shared tag_store; return its tags or None.
+
+        counts maps tag to the item count to show beside it.'''
+        self.tag_store.sync(self.model.known_tagset,lambda tag: counts.get(tag,0))
+        dialog = TagsDialog(self, self.tag_store, tags)
         response = dialog.run()
+        self.tag_store.finish(response == Gtk.ResponseType.OK)
+        tags = None
         if response == Gtk.ResponseType.OK:
-            self.tags_entry.set_text(dialog.get_tags())
-            self.known_tagset.update(dialog.get_newtag_set())
+            tags = dialog.get_tags()
+            self.learn_tags(dialog.get_newtag_set())
         dialog.destroy()
+        return tags
+
+    def on_tags_clicked(self,button):
+        tags = self.run_tags_dialog(self.normalize_tags(self.get_tags())[0],
+                self.model.facets.counts)
+        if tags is not None:
+            self.tags_entry.set_text(tags)
 
     def on_clear_clicked(self,button):
         self.selected_url = None
@@ -318,148 +738,279 @@ class TagURIt(Gtk.Window):
             response = dialog.run()
             if response == Gtk.ResponseType.YES:
                 self.clear_data()
-                treeiter = model.convert_iter_to_child_iter(treeiter)
-                model = model.get_model()
-                iid = model[treeiter][0]
-                cur = self.conn.cursor()
-                cur.execute("""DELETE FROM items WHERE iid = %s;""",(iid,))
-                model.remove(treeiter)
+                self.instruments.begin()
+                with self.instruments.phase('delete'):
+                    treeiter = model.convert_iter_to_child_iter(treeiter)
+                    undo = self.row_values(treeiter)
+                    slot = self.urlstore[treeiter][5]
+                    self.remove_row(treeiter)
+                    self.writer.put('delete',slot,undo[0],None,undo)
+                self.set_status("")
             dialog.destroy()
         else:
             self.set_status("Select an item first")
 
     def on_filter_clicked(self,button):
-        dialog = TagsDialog(self, self.known_tagset,
-                self.filter_entry.get_text().strip())
-        response = dialog.run()
-        if response == Gtk.ResponseType.OK:
-            self.filter_entry.set_text(dialog.get_tags())
+        # counts within the current filter, so you can see where to drill down
+        tags = self.run_tags_dialog(self.filter_entry.get_text().strip(),
+                self.model.facet_counts if self.model.facet_counts is not None
+                else self.model.facets.counts)
+        if tags is not None:
+            self.filter_entry.set_text(tags)
             self.refilter_items()
-            self.known_tagset.update(dialog.get_newtag_set())
-        dialog.destroy()
 
     def on_filter_activate(self,entry):
         self.refilter_items()
 
     def on_url_changed(self,entry):
         if self.get_title() == '':  #guess a candidate title
-            title = urlparse(entry.get_text()).netloc
-            if title == "github.com":
-                title = urlparse(entry.get_text()).path.split('/')[-1]
-            if title.startswith("www."):
-                title = title[4:]
-            if any([title.endswith(x) for x in (
-                ".com", ".org" ,".net",".gov", ".edu")]):
-                title = title[:-4]
-            self.set_title(title)
+            self.set_title(guess_title(entry.get_text()))
 
     def on_regex_activate(self,entry):
         self.refilter_items()
 
+    def on_filter_changed(self,entry):
+        '''Debounce keystrokes in the filter entries into one refilter.'''
+        # in server_filter mode each pass is two queries on the main loop,
+        # so only Enter filters
+        if not self.live_filter or self.server_filter:
+            return
+        # a newer keystroke abandons the pass in progress, not just the timer
+        self.cancel_filter_pass()
+        self.filter_timeout = GLib.timeout_add(FILTER_DEBOUNCE_MS,self.on_filter_timeout)
+
+    def on_filter_timeout(self):
+        self.filter_timeout = None
+        self.refilter_items()
+        return False
+
+    def cancel_filter_pass(self):
+        for source in (self.filter_timeout, self.filter_pass):
+            if source:
+                GLib.source_remove(source)
+        self.filter_timeout = self.filter_pass = None
+
     def refilter_items(self):
-        self.visible_tagset = {x for x in self.filter_entry.get_text().split()}
+        '''Start a filter pass, abandoning any pass still in progress.'''
+        self.cancel_filter_pass()
+        self.instruments.begin()
+        self.filter_started = time.perf_counter()
         pattern = self.regex_entry.get_text()
-        if pattern:
-            self.regex = re.compile(pattern,flags=re.IGNORECASE)
-        else:
-            self.regex = None
-        self.filtered_urlstore.refilter()   #see Gtk.TreeModelFilter
-        self.set_status("{0} items after applying filters".format(self.count_visible_items()))
-
-    def is_item_visible(self,model,treeiter,data):
-        iid,title,url,notes,tags = model[treeiter]
-        if self.visible_tagset:
-            item_tagset = {x for x in tags.split()}
-            item_tagset |= {x.split(':', 1)[0] for x in item_tagset if ':' in x}
-            if not self.visible_tagset <= item_tagset:
-                return False
-        if self.regex:
-            if not self.regex.search(title) \
-                    and not self.regex.search(url) \
-                    and not self.regex.search(notes) :
-                return False
+        if self.server_filter:  # the server does the filtering, POSIX regex and all
+            query = (frozenset(self.filter_entry.get_text().split()),pattern)
+            if query != self.server_query:
+                self.server_query = query
+                self.page = 0
+                self.page_starts = [None]
+                self.page_total = None
+            self.query_page()
+            return
+        try:
+            with self.instruments.phase('filter_setup'):
+                self.model.set_filter(self.filter_entry.get_text(),pattern)
+        except re.error as e:
+            self.set_status("Bad regex: {0}".format(e))
+            return
+        self.filter_row = 0
+        self.filter_pass = GLib.idle_add(self.filter_chunk)
+
+    def filter_chunk(self):
+        '''Evaluate rows for one time slice, then yield to the main loop.
+
+        Each row's result goes in its visible column, which the
+        Gtk.TreeModelFilter reads, so there is no refilter at the end;
+        only rows whose visibility changed are written.'''
+        start = time.perf_counter()
+        deadline = start + FILTER_SLICE_SECONDS
+        store, is_visible = self.urlstore, self.model.is_visible
+        treeiter = store.iter_nth_child(None,self.filter_row)
+        n = 0
+        while treeiter is not None:
+            slot, shown = store.get(treeiter,5,6)
+            visible = is_visible(slot)
+            if visible != shown:
+                store.set_value(treeiter,6,visible)
+            self.filter_row += 1
+            treeiter = store.iter_next(treeiter)
+            n += 1
+            if n & 255 == 0 and time.perf_counter() > deadline:
+                self.instruments.record('evaluate',start,time.perf_counter())
+                self.set_status("{0} items so far...".format(self.count_visible_items()))
+                return True
+        self.instruments.record('evaluate',start,time.perf_counter())
+        self.filter_pass = None
+        with self.instruments.phase('facets'):
+            self.model.finish_filter()
+        self.instruments.record('filter_pass',self.filter_started,time.perf_counter())
+        self.set_status("{0} items after applying filters{1}".format(
+                self.count_visible_items(),self.model.describe_facets()))
+        return False
+
+    def count_visible_items(self):
+        with self.instruments.phase('count'):
+            return self.model.count_visible_items()
+
+    def learn_tags(self,tags):
+        self.model.learn_tags(tags)
+
+    def normalize_tags(self,tags):
+        return self.model.normalize_tags(tags)
+
+    def attach_tag_completion(self,entry):
+        '''Complete the last word of entry from the known tags.'''
+        store = Gtk.ListStore(str)
+        completion = Gtk.EntryCompletion()
+        completion.set_model(store)
+        completion.set_text_column(0)
+        completion.set_match_func(lambda *args: True)  # store only holds matches
+        completion.connect("match-selected",self.on_completion_selected,entry)
+        entry.set_completion(completion)
+        entry.connect("changed",self.on_completion_changed,store)
+
+    def on_completion_changed(self,entry,store):
+        text = entry.get_text()
+        word = text.split()[-1] if text.strip() and not text.endswith(' ') else ''
+        store.clear()
+        if word:
+            for tag in self.model.tag_normalizer.complete(word):
+                if tag != word:
+                    store.append((tag,))
+
+    def on_completion_selected(self,completion,model,treeiter,entry):
+        text = entry.get_text()
+        words = text.split()[:-1] + [model[treeiter][0]]
+        entry.set_text(" ".join(words) + " ")
+        entry.set_position(-1)
         return True
 
-    def bump_visible_item_count(self,model,path,treeiter):
-        if self.is_item_visible(model,treeiter,None):
-            self.visible_item_count += 1
+class TagStore:
+    '''Sorted Gtk.ListStore of (checked,tag,count,new) rows for TagsDialog.
 
-    def count_visible_items(self):
-        self.visible_item_count = 0
-        self.urlstore.foreach(self.bump_visible_item_count)
-        return self.visible_item_count
-
-    def fix_plural_tags(self,tags):
-        '''replace "new" tags that differ only by a trailing 's' with the existing tag'''
-        tagset = set(tags.split())
-        for tag in tagset.difference(self.known_tagset):
-            if tag.endswith('s') and tag[0:-1] in self.known_tagset:
-                print("converting {0} to {1}".format(tag,tag[0:-1]))
-                tagset.remove(tag)
-                tagset.add(tag[0:-1])
-            elif (tag + 's') in self.known_tagset:
-                print("converting {0} to {1}".format(tag,tag+'s'))
-                tagset.remove(tag)
-                tagset.add(tag+'s')
-        return ' '.join(tagset)
+    The window keeps one of these for its lifetime, so opening the dialog
+    only adds novel tags and refreshes counts instead of building widgets.'''
+
+    CHECKED, TAG, COUNT, NEW = range(4)
+
+    def __init__(self):
+        self.store = Gtk.ListStore(bool,str,int,bool)
+        self.store.set_sort_column_id(self.TAG,Gtk.SortType.ASCENDING)
+        self.iters = dict()
+        '''tag -> iter, ListStore iters persist'''
+
+        self.checked = set()
+
+    def sync(self, tagset, count):
+        '''Add tags in tagset not yet in the store and refresh every count.'''
+        for tag in tagset.difference(self.iters):
+            self.iters[tag] = self.store.append((False,tag,0,False))
+        for tag, treeiter in self.iters.items():
+            n = count(tag)
+            if self.store[treeiter][self.COUNT] != n:
+                self.store.set_value(treeiter,self.COUNT,n)
+
+    def check(self, tags):
+        '''Check exactly tags, adding any unknown ones flagged new; return those.'''
+        newtagset = tags.difference(self.iters)
+        for tag in newtagset:
+            self.iters[tag] = self.store.append((False,tag,0,True))
+        for tag in self.checked.symmetric_difference(tags):
+            self.store.set_value(self.iters[tag],self.CHECKED,tag in tags)
+        self.checked = set(tags)
+        return newtagset
+
+    def toggle(self, treeiter):
+        tag = self.store[treeiter][self.TAG]
+        self.checked.symmetric_difference_update((tag,))
+        self.store.set_value(treeiter,self.CHECKED,tag in self.checked)
+
+    def finish(self, accepted):
+        '''Keep the new tags if the dialog was accepted, else drop them.'''
+        for tag, treeiter in list(self.iters.items()):
+            if self.store[treeiter][self.NEW]:
+                if accepted:
+                    self.store.set_value(treeiter,self.NEW,False)
+                else:
+                    self.checked.discard(tag)
+                    self.store.remove(treeiter)
+                    del self.iters[tag]
 
 class TagsDialog(Gtk.Dialog):
-    '''Dialog to select a group of tags from tagset.'''
+    '''Dialog to select a group of tags from a TagStore.'''
 
-    def __init__(self, parent, tagset, tags):
+    def __init__(self, parent, tagstore, tags):
         Gtk.Dialog.__init__(self, "Tags", parent, 0,
                 (Gtk.STOCK_CANCEL,
                 Gtk.ResponseType.CANCEL,
                 Gtk.STOCK_OK,
                 Gtk.ResponseType.OK))
-
-        pretagged = {x for x in tags.split()}
-        self.newtagset = pretagged.difference(tagset)   #in case we typed any novel tags
-
-        linelen = 0
-        self.tag_buttons = list()
-        #FIXME: I'd rather this use a FlowBox, but it's missing from my PythonGI
-        vbox = Gtk.VBox()
-        hbox = Gtk.HBox()
-        self.get_content_area().add(vbox)
-        for tag in sorted(tagset.union(self.newtagset)):
-            button = Gtk.CheckButton(tag)
-            if tag in pretagged:
-                button.set_active(True)
-            if tag in self.newtagset:
-                button.get_child().set_markup(
-                        """<span color='red'>{0}</span>""".format(escape(tag)))
-            self.tag_buttons.append(button)
-            linelen += len(tag)+3
-            if linelen > 64:
-                vbox.pack_start(hbox, False, False, 0)
-                hbox = Gtk.HBox()
-                linelen = len(tag)+3
-            hbox.pack_start(button, False, False, 6)
-        vbox.pack_start(hbox, False, False, 0)
+        self.set_default_size(360, 480)
+
+        self.tagstore = tagstore
+        self.newtagset = tagstore.check({x for x in tags.split()})   #in case we typed any novel tags
+
+        vbox = self.get_content_area()
+
+        # type-ahead search narrows the list, Enter toggles the first match
+        self.search_entry = Gtk.SearchEntry()
+        self.search_entry.connect("search-changed",self.on_search_changed)
+        self.search_entry.connect("activate",self.on_search_activate)
+        vbox.pack_start(self.search_entry, False, False, 0)
+
+        self.filtered_tags = tagstore.store.filter_new()
+        self.filtered_tags.set_visible_func(self.is_tag_visible)
+
+        # a TreeView only renders the rows on screen, however many tags there are
+        self.tag_tree = Gtk.TreeView.new_with_model(self.filtered_tags)
+        self.tag_tree.set_enable_search(False)
+        toggle = Gtk.CellRendererToggle()
+        toggle.connect("toggled",self.on_tag_toggled)
+        self.tag_tree.append_column(
+                Gtk.TreeViewColumn("", toggle, active=TagStore.CHECKED))
+        renderer = Gtk.CellRendererText(foreground="red")
+        self.tag_tree.append_column(
+                Gtk.TreeViewColumn("Tag", renderer,
+                    text=TagStore.TAG, foreground_set=TagStore.NEW))
+        self.tag_tree.append_column(
+                Gtk.TreeViewColumn("Items", Gtk.CellRendererText(), text=TagStore.COUNT))
+        sw = Gtk.ScrolledWindow.new(None,None)
+        sw.add(self.tag_tree)
+        vbox.pack_start(sw, True, True, 0)
 
         button = Gtk.Button.new_with_label("Clear")
         button.connect("clicked",self.on_clear_clicked)
         vbox.pack_start(button, False, False, 0)
 
         self.show_all()
+        self.search_entry.grab_focus()
+
+    def is_tag_visible(self,model,treeiter,data):
+        text = self.search_entry.get_text().strip().lower()
+        return not text or text in model[treeiter][TagStore.TAG]
+
+    def on_search_changed(self,entry):
+        self.filtered_tags.refilter()
+
+    def on_search_activate(self,entry):
+        treeiter = self.filtered_tags.get_iter_first()
+        if treeiter:
+            self.tagstore.toggle(self.filtered_tags.convert_iter_to_child_iter(treeiter))
+            entry.set_text("")
+
+    def on_tag_toggled(self,renderer,path):
+        treeiter = self.filtered_tags.get_iter(path)
+        self.tagstore.toggle(self.filtered_tags.convert_iter_to_child_iter(treeiter))
 
     def on_clear_clicked(self,button):
-        for button in self.tag_buttons:
-            button.set_active(False)
+        for tag in list(self.tagstore.checked):
+            self.tagstore.toggle(self.tagstore.iters[tag])
 
     def get_tags(self):
-        tags = list()
-        for button in self.tag_buttons:
-            if button.get_active():
-                tags.append(button.get_label())
-        return " ".join(tags)
+        return " ".join(sorted(self.tagstore.checked))
 
     def get_newtag_set(self):
         return self.newtagset
 
 
-
 win = TagURIt()
 win.connect("delete-event", Gtk.main_quit)
 win.show_all()
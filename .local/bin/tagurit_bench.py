@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+'''Time TagURIt's ItemModel on synthetic collections and report regressions.
+
+Each phase of the GUI's hot path is timed against an in-memory stand-in
+for the database, so neither a display nor Postgres is needed. Results
+are compared with a saved baseline; any phase more than --threshold
+slower is reported and the exit status is 1.
+
+    tagurit_bench.py                    # 10k, 100k and 1M items
+    tagurit_bench.py -s 10000 --save    # record a new baseline
+'''
+import re
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+from itertools import accumulate
+from contextlib import redirect_stdout
+from tagurit_core import (LOAD_BATCH_SIZE, ItemModel, WriteBehind,
+        open_snapshot, write_snapshot)
+
+SIZES = (10000, 100000, 1000000)
+
+BASELINE_PATH = os.path.join(
+        os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+        'tagurit', 'bench.json')
+
+NOISE_SECONDS = 0.005
+'''Differences smaller than this are never called regressions.'''
+
+SYLLABLES = ('ka', 'lo', 'mi', 'ne', 'ru', 'ta', 'vo', 'zen', 'py', 'th', 'on',
+        'dat', 'ux', 'web', 'gra', 'ph', 'io', 'sel', 'bit', 'cor')
+
+NAMESPACES = ('lang', 'topic', 'via')
+
+class MemoryCursor:
+    '''Just enough of a DB-API cursor for the statements TagURIt runs.'''
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.rows = iter(())
+
+    def execute(self, sql, args=()):
+        verb = sql.split(None, 1)[0].upper()
+        items = self.conn.items
+        if verb == 'SELECT':
+            self.rows = iter(sorted(((iid,) + row for iid, row in items.items()),
+                    key=lambda x: x[1]))
+        elif verb == 'INSERT':
+            self.conn.last_iid += 1
+            items[self.conn.last_iid] = tuple(args)
+            self.rows = iter(((self.conn.last_iid,),))
+        elif verb == 'UPDATE':
+            items[args[-1]] = tuple(args[:-1])
+        elif verb == 'DELETE':
+            items.pop(args[0], None)
+
+    def fetchone(self):
+        return next(self.rows, None)
+
+    def fetchmany(self, size):
+        return [row for _, row in zip(range(size), self.rows)]
+
+    def close(self):
+        pass
+
+class MemoryConnection:
+    '''An items table held in a dict, standing in for psycopg2.'''
+
+    def __init__(self, rows=()):
+        self.items = {n + 1: tuple(row) for n, row in enumerate(rows)}
+        self.last_iid = len(self.items)
+        self.closed = False
+
+    def cursor(self):
+        return MemoryCursor(self)
+
+    def close(self):
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+def zipf_weights(n, s=1.1):
+    '''Return cumulative weights, which choices would otherwise add up on every call.'''
+    return list(accumulate(1 / (rank ** s) for rank in range(1, n + 1)))
+
+def make_words(rnd, n):
+    words = set()
+    while len(words) < n:
+        words.add(''.join(rnd.choice(SYLLABLES) for _ in range(rnd.randint(2, 4))))
+    return sorted(words)
+
+def make_dataset(size, seed=1):
+    '''Return size (title,url,notes,tags) rows with Zipf distributed words and tags.
+
+    Tags are drawn from a vocabulary that grows with the collection, a few
+    of them namespaced, with most items having two or three tags; urls
+    share hosts and some carry tracking parameters or a trailing slash.'''
+    rnd = random.Random(seed)
+    words = make_words(rnd, min(20000, max(500, size // 5)))
+    word_weights = zipf_weights(len(words))
+    tags = make_words(rnd, min(5000, max(100, size // 50)))
+    tags = [rnd.choice(NAMESPACES) + ':' + x if rnd.random() < 0.05 else x for x in tags]
+    tag_weights = zipf_weights(len(tags))
+    hosts = ['{0}.{1}'.format(x, rnd.choice(('com', 'org', 'net', 'io')))
+             for x in make_words(rnd, max(50, size // 20))]
+    host_weights = zipf_weights(len(hosts), 0.9)
+    rows = list()
+    for n in range(size):
+        title = ' '.join(rnd.choices(words, cum_weights=word_weights, k=rnd.randint(2, 7))).capitalize()
+        url = 'https://{0}/{1}/{2}'.format(rnd.choices(hosts, cum_weights=host_weights)[0],
+                '/'.join(rnd.choices(words, cum_weights=word_weights, k=rnd.randint(1, 3))), n)
+        if rnd.random() < 0.1:
+            url += '?utm_source=feed'
+        elif rnd.random() < 0.1:
+            url += '/'
+        notes = ''
+        if rnd.random() < 0.3:
+            notes = ' '.join(rnd.choices(words, cum_weights=word_weights, k=rnd.randint(3, 12)))
+        itemtags = set(rnd.choices(tags, cum_weights=tag_weights, k=rnd.choice((1, 2, 2, 3, 3, 4, 6))))
+        rows.append((title, url, notes, ' ' + ' '.join(sorted(itemtags)) + ' '))
+    return rows
+
+def filter_all(model, tags, pattern):
+    '''Filter the whole model as a refilter pass would; return the count.'''
+    model.set_filter(tags, pattern)
+    is_visible = model.is_visible
+    for slot in list(model.item_text):
+        is_visible(slot)
+    model.finish_filter()
+    return model.count_visible_items()
+
+def scan_count(rows, tags, pattern):
+    '''Count rows matching the filter the slow obvious way, to check the model.'''
+    tagset = set(tags.split())
+    regex = re.compile(pattern, flags=re.IGNORECASE) if pattern else None
+    return sum(1 for title, url, notes, itemtags in rows
+               if tagset <= set(itemtags.split())
+               and (not regex or any(regex.search(x) for x in (title, url, notes))))
+
+class Timer:
+    '''Keep the fastest of several runs of each phase.'''
+
+    def __init__(self):
+        self.best = dict()
+
+    def __call__(self, phase, func, *args):
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+        self.best[phase] = min(elapsed, self.best.get(phase, elapsed))
+        return result
+
+def run(size, repeat=3, seed=1):
+    '''Return {phase: seconds} for a collection of size items, and any check failures.'''
+    rows = make_dataset(size, seed)
+    rnd = random.Random(seed + 1)
+    tag_counts = dict()
+    for row in rows:
+        for tag in row[3].split():
+            tag_counts[tag] = tag_counts.get(tag, 0) + 1
+    common = sorted(tag_counts, key=lambda x: -tag_counts[x])
+    word = rows[0][0].split()[0].lower()
+    probes = [rnd.choice(rows)[1] for _ in range(500)] \
+            + ['https://example.com/new/{0}'.format(n) for n in range(500)]
+    typed = [' '.join(rnd.choice(common[:200]).upper() if rnd.random() < 0.5
+                      else rnd.choice(common[:200]) + 's' for _ in range(3))
+             for _ in range(1000)]
+    filters = {
+        'filter_tag': (common[0], ''),
+        'filter_narrow': (common[0] + ' ' + common[1], ''),
+        'regex_literal': ('', word),
+        'regex': ('', r'{0}.*{1}'.format(word[:2], word[-2:])),
+        'filter_tag_regex': (common[2], word),
+    }
+    failures = list()
+    timer = Timer()
+    with tempfile.TemporaryDirectory() as tmp:
+        snapshot = os.path.join(tmp, 'items.sqlite')
+        for n in range(repeat):
+            db = MemoryConnection(rows)
+            model = ItemModel()
+
+            def load():
+                cur = db.cursor()
+                cur.execute("""SELECT iid,title,url,notes,tags FROM items ORDER BY title;""")
+                while True:
+                    batch = cur.fetchmany(LOAD_BATCH_SIZE)
+                    model.add_rows(batch)
+                    if len(batch) < LOAD_BATCH_SIZE:
+                        break
+            timer('load', load)
+
+            def snapshot_round_trip():
+                write_snapshot(snapshot, ((iid,) + row for iid, row in db.items.items()),
+                        '-infinity', 0)
+                cur, _, _ = open_snapshot(snapshot)
+                while cur.fetchmany(LOAD_BATCH_SIZE):
+                    pass
+            timer('snapshot', snapshot_round_trip)
+
+            for phase, (tags, pattern) in filters.items():
+                count = timer(phase, filter_all, model, tags, pattern)
+                if n == 0 and count != scan_count(rows, tags, pattern):
+                    failures.append('{0} {1}: {2} visible, expected {3}'.format(
+                            size, phase, count, scan_count(rows, tags, pattern)))
+            timer('unfilter', filter_all, model, '', '')
+
+            timer('duplicates', lambda: [model.is_duplicate_url(x)
+                    or model.url_index.find_near(x) for x in probes])
+            timer('normalize', lambda: [model.normalize_tags(x) for x in typed])
+
+            iids = {slot: iid for iid, slot in model.slot_by_iid.items()}
+
+            def sync():
+                posted = list()
+                writer = WriteBehind(lambda: db, lambda func, *args: posted.append((func, args)),
+                        lambda inserted: [model.set_iid(slot, iid) for slot, iid in inserted],
+                        lambda ops, error: failures.append('{0} sync: {1}'.format(size, error)),
+                        linger=0)
+                for slot in list(model.item_text)[:500]:
+                    title, url, notes = model.item_text[slot]
+                    model.update_row(slot, title + ' again', url, notes, 'edited')
+                    writer.put('update', slot, iids[slot], (title, url, notes, ' edited '))
+                for k in range(500):
+                    row = ('New {0}'.format(k), 'https://example.org/{0}'.format(k), '', ' new ')
+                    slot = model.add_rows(((0,) + row,))[0][5]
+                    writer.put('insert', slot, 0, row)
+                writer.close()
+                for func, args in posted:
+                    func(*args)
+            timer('sync', sync)
+    return timer.best, failures
+
+def compare(results, baseline, threshold):
+    '''Print results beside the baseline; return the phases that regressed.'''
+    regressions = list()
+    print('{0:>8} {1:<17} {2:>10} {3:>10} {4:>8}'.format(
+            'items', 'phase', 'seconds', 'baseline', 'change'))
+    for size, phases in results.items():
+        for phase, seconds in phases.items():
+            base = baseline.get(size, {}).get(phase)
+            change = ''
+            if base:
+                change = '{0:+.0%}'.format(seconds / base - 1)
+                if seconds > base * (1 + threshold) and seconds - base > NOISE_SECONDS:
+                    regressions.append((size, phase))
+                    change += ' !'
+            print('{0:>8} {1:<17} {2:>10.4f} {3:>10} {4:>8}'.format(size, phase, seconds,
+                    '{0:.4f}'.format(base) if base else '-', change))
+    return regressions
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-s', '--sizes', default=','.join(str(x) for x in SIZES),
+            help='comma separated item counts (default %(default)s)')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+            help='runs per size, the fastest is kept (default %(default)s)')
+    parser.add_argument('-b', '--baseline', default=BASELINE_PATH)
+    parser.add_argument('-t', '--threshold', type=float, default=0.2,
+            help='fractional slowdown counted as a regression (default %(default)s)')
+    parser.add_argument('--save', action='store_true', help='record these results as the baseline')
+    args = parser.parse_args(argv)
+
+    try:
+        with open(args.baseline) as fh:
+            baseline = json.load(fh)
+    except (OSError, ValueError):
+        baseline = dict()
+    results = dict()
+    failures = list()
+    for size in args.sizes.split(','):
+        # normalize_tags prints each conversion
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            results[size], failed = run(int(size), args.repeat)
+        failures += failed
+    regressions = compare(results, baseline, args.threshold)
+    for failure in failures:
+        print('wrong result:', failure)
+    if args.save:
+        baseline.update(results)
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, 'w') as fh:
+            json.dump(baseline, fh, indent=1, sort_keys=True)
+    elif regressions:
+        print('{0} regressions against {1}'.format(len(regressions), args.baseline))
+    return 1 if failures or (regressions and not args.save) else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -1,11 +1,31 @@
 import datetime
 import os
+import sys
+import json
+import time
 import fcntl
+import random
+import tempfile
+import warnings
+from array import array
 from collections import OrderedDict
+from collections.abc import Mapping
+
+# Stands in for an unset Volume, as NaN does for the other numeric fields
+MISSING_INT = -2 ** 63
+
+# A journal grown past this, and past the csv's own size, is folded into the csv
+COMPACT_BYTES = 1 << 20
+
+# First wait between attempts at a lock held by another process, doubled
+# after each attempt up to LOCK_BACKOFF_MAX
+LOCK_BACKOFF = 0.01
+LOCK_BACKOFF_MAX = 0.5
 
 
 class openextra:
-    def __init__(self, date=None):
+    def __init__(self, date=None, journal=False, compact_bytes=COMPACT_BYTES,
+                 readonly=False, snapshot=False, timeout=0, backoff=LOCK_BACKOFF):
         self.field_names_formats = OrderedDict([
             ('Name', '\"%s\"'),
             ('Symbol', '\"%s\"'),
@@ -35,7 +55,25 @@ class openextra:
 
         self.date = parsed_date.strftime('%Y-%m-%d')
         self.filename = f"/home/dunc/data/eod/extra.{parsed_date.strftime('%Y%m%d')}.csv"
-        self.rows = {}
+        self._new_store()
+
+        # In journal mode printrow updates are appended to a journal beside
+        # the csv by write(), and the csv is only read, and rewritten, when
+        # the journal is compacted; a plain write() compacts it as well
+        self.journal = journal
+        self.journal_filename = self.filename + '.journal'
+        self.compact_bytes = compact_bytes
+        self.pending = []
+        self.loaded = False
+
+        # A read-only session reads the file under a shared lock, or under
+        # none at all for a snapshot, since writers publish a new csv by
+        # renaming it into place. Waiting for a lock gives up after timeout
+        # seconds: 0 fails at once, as Perl's LOCK_NB did, None never does.
+        self.readonly = readonly or snapshot
+        self.snapshot = snapshot
+        self.timeout = timeout
+        self.backoff = backoff
 
         # Mimic file handling and locking from Perl
         self._open_and_load_file()
@@ -54,83 +92,438 @@ class openextra:
         # Add more date formats as needed
         return datetime.date.today()  # Fallback
 
+    def _new_store(self):
+        # Rows are held a column per field: a typed array for each numeric
+        # field, by its format, and interned strings for Name and Symbol.
+        # Values are formatted only when the file is written.
+        self.index = {}
+        self.size = 0
+        self.capacity = 0
+        self.columns = OrderedDict()
+        self.missing = {}
+        self.converters = {}
+        for fn, fmt in self.field_formats.items():
+            if fmt == '\"%s\"':
+                self.columns[fn] = []
+                self.missing[fn] = ''
+                self.converters[fn] = lambda value: sys.intern(str(value))
+            elif fmt.endswith('d'):
+                self.columns[fn] = array('q')
+                self.missing[fn] = MISSING_INT
+                self.converters[fn] = int
+            else:
+                self.columns[fn] = array('d')
+                self.missing[fn] = float('nan')
+                self.converters[fn] = float
+        # Cells read from the file that wouldn't be written back as they
+        # were, by (row, field), kept as they were read; None for a field
+        # past the end of a short line
+        self.raw = {}
+        # Fields past the last of field_names, by row
+        self.extra = {}
+
+    def _grow(self):
+        # Add room for at least as many rows again, so adding rows one at a
+        # time doesn't extend every column each time
+        capacity = max(self.size, 2 * self.capacity, 64)
+        for fn, column in self.columns.items():
+            filler = [self.missing[fn]] * (capacity - self.capacity)
+            column.extend(filler if isinstance(column, list) else array(column.typecode, filler))
+        self.capacity = capacity
+
+    def _positions(self, symbols):
+        # The row of each symbol, adding rows for new ones
+        index = self.index
+        new = [s for s in symbols if s not in index]
+        if new:
+            new = list(dict.fromkeys(new))
+            start = self.size
+            self.size += len(new)
+            if self.size > self.capacity:
+                self._grow()
+            for k, symbol in enumerate(new):
+                index[symbol] = start + k
+            self.columns['Symbol'][start:self.size] = new
+        return [index[s] for s in symbols]
+
     def _open_and_load_file(self):
-        # Using 'r+' mode for read/write, creating if not exists
-        # 'a+' could also work, but 'r+' with truncate is closer to Perl's logic
-        # Use a+ to allow creating and reading
-        self.fh = open(self.filename, 'a+')
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        while True:
+            # Use a+ to allow creating and reading; readers create nothing
+            try:
+                self.fh = open(self.filename, 'r' if self.readonly else 'a+')
+            except FileNotFoundError:
+                # Only a reader can go without the csv; a writer can't
+                # create it, e.g. for want of its directory
+                if not self.readonly:
+                    raise
+                self.fh = None
+                if not self.snapshot:
+                    break
+            if self.snapshot:
+                # Without a lock a compaction can land between reading the
+                # csv and reading the journal, and a writer start a new
+                # journal, pairing the old csv with updates it lacks; read
+                # both again until the csv is the same one afterwards
+                self._load_all()
+                if self._is_current():
+                    break
+                if self.fh:
+                    self.fh.close()
+                self._new_store()
+                continue
 
-        # Acquire an exclusive lock
+            # Acquire a shared lock to read, an exclusive one to write
+            self._lock(fcntl.LOCK_SH if self.readonly else fcntl.LOCK_EX, deadline)
+
+            # A writer may have renamed a new csv into place while we waited
+            # for the lock on the old one
+            if self._is_current():
+                break
+            self.fh.close()
+
+        if not self.loaded and (self.readonly or not self.journal):
+            self._load_all()
+        if self.readonly:
+            self.close()
+
+    def _lock(self, operation, deadline):
+        delay = self.backoff
+        while True:
+            try:
+                fcntl.flock(self.fh, operation | fcntl.LOCK_NB)
+                return
+            except IOError as e:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    self.fh.close()
+                    self.fh = None
+                    raise Exception(f"Can't lock {self.filename}: {e}")
+            # Jittered, so writers queued on the same file don't retry in step
+            wait = delay * random.uniform(0.5, 1)
+            time.sleep(wait if remaining is None else min(wait, remaining))
+            delay = min(delay * 2, LOCK_BACKOFF_MAX)
+
+    def _is_current(self):
+        # Whether the open csv, or its absence, is still what is in place
         try:
-            fcntl.flock(self.fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
-        except IOError as e:
-            raise Exception(f"Can't lock {self.filename}: {e}")
+            st = os.stat(self.filename)
+        except FileNotFoundError:
+            return self.fh is None
+        if self.fh is None:
+            return False
+        fst = os.fstat(self.fh.fileno())
+        return (st.st_dev, st.st_ino) == (fst.st_dev, fst.st_ino)
 
+    def _load_all(self):
         # Read existing data, skipping header lines
-        self.fh.seek(0)  # Go to the beginning of the file to read
-        lines = self.fh.readlines()
+        lines = []
+        if self.fh:
+            self.fh.seek(0)  # Go to the beginning of the file to read
+            lines = self.fh.readlines()
 
         # Skip the first 4 lines if they exist, similar to Perl's < $fh >
         if len(lines) >= 4:
-            for line in lines[4:]:
-                line = line.strip()
-                if line:
-                    parts = line.split(',')
-                    # Assuming the symbol is the second field in the CSV
-                    if len(parts) > 1:
-                        # Remove quotes if present
-                        symbol = parts[1].strip('\"')
-                        if symbol:
-                            self.rows[symbol] = parts
-                        else:
-                            raise Exception(
-                                f"Missing symbol in {self.filename}: {line}\n")
+            self._load(lines[4:])
+
+        # Then the updates journaled since the csv was last written, and any
+        # made here since opening
+        self._replay()
+        self.loaded = True
+        for symbols, converted in self.pending:
+            self._merge(symbols, converted)
+
+    def _csv_identity(self):
+        # What a journal records of the csv it extends, so a csv replaced or
+        # rewritten in place since, by compaction or by the Perl module, is
+        # not paired with updates it already has or that it overrides
+        if not self.fh:
+            return None
+        st = os.fstat(self.fh.fileno())
+        return [st.st_ino, st.st_size, st.st_mtime_ns]
 
+    def _replay(self):
+        try:
+            with open(self.journal_filename) as jh:
+                lines = jh.readlines()
+        except FileNotFoundError:
+            return
+        # A last line without its newline is a record torn by a crash
+        records = [json.loads(line) for line in lines if line.endswith('\n')]
+        if not records:
+            return
+        # The first is a header naming the csv the journal was started on
+        if records.pop(0).get('csv') != self._csv_identity():
+            warnings.warn(f"Ignoring {self.journal_filename}, "
+                          f"{self.filename} has changed since it was started")
+            return
+        self._merge(*self._convert_rows(records))
+
+    def _load(self, lines):
+        # Fill the empty store from the file's data lines, a column at a time
+        width = len(self.field_names)
+        rows = {}
+        # Fields on the line, by symbol, for lines short of width
+        short = {}
+        for line in lines:
+            line = line.strip()
+            if line:
+                parts = line.split(',')
+                # Assuming the symbol is the second field in the CSV
+                if len(parts) > 1:
+                    # Remove quotes if present
+                    symbol = parts[1].strip('\"')
+                    if symbol:
+                        symbol = sys.intern(symbol)
+                        short.pop(symbol, None)
+                        if len(parts) < width:
+                            short[symbol] = len(parts)
+                            parts += [''] * (width - len(parts))
+                        # A later line for a symbol replaces the earlier one
+                        rows[symbol] = parts
+                    else:
+                        raise Exception(
+                            f"Missing symbol in {self.filename}: {line}\n")
+
+        n = len(rows)
+        self._positions(list(rows))
+        for fn, texts in zip(self.field_names, zip(*rows.values())):
+            column = self.columns[fn]
+            if isinstance(column, list):
+                column[:n] = [sys.intern(text.strip('\"')) for text in texts]
+            else:
+                convert = self.converters[fn]
+                placeholder = str(self.missing[fn])
+                values = [text if text and text != '...' else placeholder for text in texts]
+                try:
+                    column[:n] = array(column.typecode, map(convert, values))
+                except ValueError:
+                    # Not all numbers, those that aren't are kept below
+                    for pos, value in enumerate(values):
+                        try:
+                            column[pos] = convert(value)
+                        except ValueError:
+                            pass
+            # Keep the text of any cell that formatting would change, so
+            # rewriting the file only changes the cells that were updated
+            for pos, (text, out) in enumerate(zip(texts, self._format_column(fn, column[:n]))):
+                if text != out:
+                    self.raw[(pos, fn)] = text
+
+        for pos, (symbol, parts) in enumerate(rows.items()):
+            if len(parts) > width:
+                self.extra[pos] = parts[width:]
+            elif symbol in short:
+                for fn in self.field_names[short[symbol]:]:
+                    self.raw[(pos, fn)] = None
 
     def printrow(self, **fields):
+        if self.journal:
+            self.printrows([fields])
+            return
+
         symbol = fields.get('Symbol')
         if not symbol or symbol == '...' or symbol == '\"\"':
             raise ValueError("missing symbol in printrow")
 
-        output_parts = []
-        for i, fn in enumerate(self.field_names):
-            if fn in fields and fields[fn] is not None:
-                # Format the field based on its defined format
-                if isinstance(self.field_formats[fn], str):
-                    output_parts.append(self.field_formats[fn] % fields[fn])
-                else:
-                    # This case should ideally not happen if formats are always strings
-                    output_parts.append(str(fields[fn]))
-            elif symbol in self.rows and self.rows[symbol][i]:
-                # Use fields existing value, if there is one
-                output_parts.append(self.rows[symbol][i])
+        converters = self.converters
+        values = [(fn, converters[fn](value)) for fn, value in fields.items()
+                  if value is not None and fn in converters]
+        pos = self.index.get(symbol)
+        if pos is None:
+            pos = self._positions([converters['Symbol'](symbol)])[0]
+        columns = self.columns
+        for fn, value in values:
+            columns[fn][pos] = value
+        if self.raw:
+            for fn, value in values:
+                self.raw.pop((pos, fn), None)
+
+    def printrows(self, rows):
+        # Merge many rows in one pass: rows is an iterable of printrow style
+        # mappings, or a mapping of field name to a column of values with
+        # Symbol among them. A None value leaves the field as it was.
+        symbols, converted = self._convert_rows(rows)
+        if self.journal:
+            self.pending.append((symbols, converted))
+        if self.loaded:
+            self._merge(symbols, converted)
+
+    def _convert_rows(self, rows):
+        if isinstance(rows, Mapping):
+            columns = {fn: list(values) for fn, values in rows.items() if fn in self.columns}
+            symbols = columns.get('Symbol', [])
+            if any(len(values) != len(symbols) for values in columns.values()):
+                raise ValueError("printrows columns differ in length")
+        else:
+            rows = list(rows)
+            symbols = [row.get('Symbol') for row in rows]
+            present = set().union(*rows)
+            columns = {fn: [row.get(fn) for row in rows] for fn in self.field_names if fn in present}
+        for symbol in symbols:
+            if not symbol or symbol == '...' or symbol == '\"\"':
+                raise ValueError("missing symbol in printrow")
+
+        # Convert everything first, so a bad value changes no rows
+        converted = {}
+        for fn, values in columns.items():
+            convert = self.converters[fn]
+            converted[fn] = [None if v is None else convert(v) for v in values]
+        return converted.pop('Symbol', []), converted
+
+    def _merge(self, symbols, converted):
+        positions = self._positions(symbols)
+        raw = self.raw
+        for fn, values in converted.items():
+            column = self.columns[fn]
+            for pos, value in zip(positions, values):
+                if value is not None:
+                    column[pos] = value
+                    if raw:
+                        raw.pop((pos, fn), None)
+
+    def _format_column(self, fn, column):
+        # A column's values as text, an unset number as '...'
+        fmt = self.field_formats[fn]
+        if isinstance(column, list):
+            return [fmt % v for v in column]
+        if column.typecode == 'q':
+            return [fmt % v if v != MISSING_INT else '...' for v in column]
+        # NaN, an unset value, is the only value not equal to itself
+        return [fmt % v if v == v else '...' for v in column]
+
+    def _formatted(self):
+        # The rows' fields as text, in row order
+        formatted = [self._format_column(fn, column[:self.size])
+                     for fn, column in self.columns.items()]
+        position = {fn: i for i, fn in enumerate(self.columns)}
+        ragged = set(self.extra)
+        for (pos, fn), text in self.raw.items():
+            formatted[position[fn]][pos] = text
+            if text is None:
+                ragged.add(pos)
+        lines = list(zip(*formatted))
+        # Short lines stay short, up to the last field set since, and long
+        # ones keep the fields past the last of field_names
+        for pos in ragged:
+            line = list(lines[pos])
+            while line and line[-1] is None:
+                line.pop()
+            lines[pos] = ['' if text is None else text for text in line] + self.extra.get(pos, [])
+        return lines
+
+    @property
+    def rows(self):
+        # The rows as lists of formatted fields by symbol, as the Perl module
+        # keeps them; built on each access, so update with printrows()
+        if not self.loaded:
+            self._load_all()
+        return dict(zip(self.columns['Symbol'][:self.size], (list(x) for x in self._formatted())))
+
+    def _append_journal(self):
+        # Append the pending updates to the journal, one json record each;
+        # return the journal's size
+        lines = []
+        for symbols, converted in self.pending:
+            fields = list(converted.items())
+            for k, symbol in enumerate(symbols):
+                record = {'Symbol': symbol}
+                for fn, values in fields:
+                    if values[k] is not None:
+                        record[fn] = values[k]
+                lines.append(json.dumps(record, separators=(',', ':')) + '\n')
+        self.pending = []
+        if not lines:
+            try:
+                return os.path.getsize(self.journal_filename)
+            except FileNotFoundError:
+                return 0
+
+        with open(self.journal_filename, 'ab+') as jh:
+            end = jh.seek(0, os.SEEK_END)
+            header = json.dumps({'csv': self._csv_identity()}, separators=(',', ':')) + '\n'
+            if end:
+                # A journal started on another csv is stale, start afresh
+                jh.seek(0)
+                if jh.readline() != header.encode():
+                    jh.truncate(0)
+                    end = 0
+            if not end:
+                lines.insert(0, header)
             else:
-                # Use default placeholder if field is not defined
-                if self.field_formats[fn] == '\"%s\"':
-                    output_parts.append('\"\"')
-                else:
-                    output_parts.append('...')
-        self.rows[symbol] = output_parts
+                jh.seek(end - 1)
+                if jh.read(1) != b'\n':
+                    # Drop a record torn by a crash, or ours would be joined to it
+                    start = max(0, end - 65536)
+                    jh.seek(start)
+                    jh.truncate(start + jh.read().rfind(b'\n') + 1)
+            jh.write(''.join(lines).encode())
+            return jh.tell()
 
     def write(self):
-        # Truncate the file to prepare for writing new data
-        self.fh.seek(0)
-        self.fh.truncate(0)
-
-        # Write header
-        display_date = datetime.datetime.strptime(
-            self.date, '%Y-%m-%d').strftime('%A, %B %d, %Y')
-        self.fh.write("EXTRA closing data\n")
-        self.fh.write(f"\"{display_date} 5:55 PM\"\n")
-        self.fh.write("\n")
-        self.fh.write(','.join(self.field_names) + "\n")
-
-        # Write data lines
-        for symbol in sorted(self.rows.keys()):
-            line = ','.join(self.rows[symbol]) + "\n"
-            self.fh.write(line)
+        if self.readonly:
+            raise Exception(f"{self.filename} is open read-only")
+        if self.journal:
+            size = self._append_journal()
+            csv_size = os.fstat(self.fh.fileno()).st_size
+            if csv_size and size <= max(self.compact_bytes, csv_size):
+                self.close()
+                return
+        self.compact()
         self.close()
 
+    def compact(self):
+        # Write the csv in full, the journal folded in, and remove the journal
+        if self.readonly:
+            raise Exception(f"{self.filename} is open read-only")
+        if not self.loaded:
+            self._load_all()
+        self.pending = []
+
+        # Write a new file beside the csv and rename it over the csv, so
+        # readers see either the old file or the new one, never a partial one
+        directory = os.path.dirname(self.filename)
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(self.filename) + '.')
+        fh = open(fd, 'w+')
+        try:
+            # Nobody else can have the new file yet; this carries our lock
+            # across the rename, for writers that find it once they get the
+            # lock on the old one
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            os.fchmod(fd, os.fstat(self.fh.fileno()).st_mode & 0o777)
+
+            # Write header
+            display_date = datetime.datetime.strptime(
+                self.date, '%Y-%m-%d').strftime('%A, %B %d, %Y')
+            fh.write("EXTRA closing data\n")
+            fh.write(f"\"{display_date} 5:55 PM\"\n")
+            fh.write("\n")
+            fh.write(','.join(self.field_names) + "\n")
+
+            # Write data lines
+            lines = self._formatted()
+            symbols = self.columns['Symbol'][:self.size]
+            fh.writelines(','.join(lines[i]) + "\n"
+                          for i in sorted(range(len(symbols)), key=symbols.__getitem__))
+            fh.flush()
+            os.fsync(fh.fileno())
+            os.replace(tmp, self.filename)
+        except BaseException:
+            fh.close()
+            os.unlink(tmp)
+            raise
+        self.fh.close()
+        self.fh = fh
+
+        # The new csv must be on disk before the journal it replaces is gone
+        dirfd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(dirfd)
+        finally:
+            os.close(dirfd)
+        if os.path.exists(self.journal_filename):
+            os.unlink(self.journal_filename)
+
     def close(self):
         if self.fh:
             self.fh.close()
@@ -239,3 +632,46 @@ if __name__ == "__main__":
         print(f"Error: {e}")
     finally:
         extra.close()
+
+    # Example 5: Bulk merge
+    print("\n--- Example 5: Bulk merge ---")
+    try:
+        extra = openextra()
+        extra.printrows({'Symbol': ["AAPL", "GOOG", "MSFT"],
+                         'Close': [156.25, 2541.10, None],
+                         'Volume': [12000000, 5100000, 7900000]})
+        extra.write()
+        print(f"Data written to {extra.get_filename()}")
+
+    except Exception as e:
+        print(f"Error: {e}")
+    finally:
+        extra.close()
+
+    # Example 6: Journaled update
+    print("\n--- Example 6: Journaled update ---")
+    try:
+        extra = openextra(journal=True)
+        extra.printrow(Symbol="AAPL", Close=156.75)
+        extra.write()
+        print(f"Update journaled to {extra.journal_filename}")
+
+    except Exception as e:
+        print(f"Error: {e}")
+    finally:
+        extra.close()
+
+    # Example 7: Reading while a writer waits its turn
+    print("\n--- Example 7: Concurrent reader and writer ---")
+    try:
+        extra = openextra(timeout=5)
+        report = openextra(snapshot=True)
+        print(f"Snapshot has {len(report.rows)} rows")
+        extra.printrow(Symbol="MSFT", Close=305.25)
+        extra.write()
+        print(f"Data written to {extra.get_filename()}")
+
+    except Exception as e:
+        print(f"Error: {e}")
+    finally:
+        extra.close()
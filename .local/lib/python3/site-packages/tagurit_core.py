@@ -0,0 +1,1407 @@
+"""GTK-free core of TagURIt: the item model, its indexes and database helpers.
+
+tagurit.py wraps ItemModel in a window; tagurit_bench.py times it on
+synthetic data.
+"""
+import re
+import time
+import queue
+import threading
+from collections import namedtuple, deque
+from contextlib import contextmanager
+from array import array
+import configparser, os
+import sqlite3
+import tempfile
+import csv
+import io
+import json
+import html
+from html.parser import HTMLParser
+from urllib.parse import urlparse, urlsplit, urlunsplit, parse_qsl, urlencode
+
+LOAD_BATCH_SIZE = 2000
+'''Rows fetched from the server-side cursor per idle callback at startup.'''
+
+SNAPSHOT_PATH = os.path.join(
+        os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+        'tagurit', 'items.sqlite')
+'''Default local copy of the items table, see open_snapshot.'''
+
+DELTA_SCHEMA = """
+ALTER TABLE items ADD COLUMN IF NOT EXISTS updated_at timestamptz NOT NULL DEFAULT now();
+CREATE INDEX IF NOT EXISTS items_updated_at ON items (updated_at);
+CREATE OR REPLACE FUNCTION items_touch() RETURNS trigger AS $$
+    BEGIN NEW.updated_at := clock_timestamp(); RETURN NEW; END $$ LANGUAGE plpgsql;
+DROP TRIGGER IF EXISTS items_touch ON items;
+CREATE TRIGGER items_touch BEFORE INSERT OR UPDATE ON items
+    FOR EACH ROW EXECUTE FUNCTION items_touch();
+CREATE TABLE IF NOT EXISTS deleted_items (
+    did bigserial PRIMARY KEY,
+    iid integer NOT NULL,
+    deleted_at timestamptz NOT NULL DEFAULT now());
+CREATE OR REPLACE FUNCTION items_log_delete() RETURNS trigger AS $$
+    BEGIN INSERT INTO deleted_items (iid) VALUES (OLD.iid); RETURN OLD; END $$ LANGUAGE plpgsql;
+DROP TRIGGER IF EXISTS items_log_delete ON items;
+CREATE TRIGGER items_log_delete AFTER DELETE ON items
+    FOR EACH ROW EXECUTE FUNCTION items_log_delete();
+CREATE INDEX IF NOT EXISTS items_url_key ON items (rtrim(url, '/'));
+"""
+'''Change tracking needed for delta sync, applied by ensure_delta_schema.
+
+items_url_key serves the duplicate check on Sync for rows not held locally.'''
+
+DELTA_OVERLAP = '1 minute'
+'''Refetch rows this far behind the high-water mark to cover late commits.'''
+
+SEARCH_SCHEMA = """
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE OR REPLACE FUNCTION tagurit_tag_keys(tags text) RETURNS text[]
+    LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+    SELECT coalesce(array_agg(DISTINCT k), '{}') FROM (
+        SELECT t FROM unnest(string_to_array(tags, ' ')) t WHERE t <> ''
+        UNION
+        SELECT split_part(t, ':', 1) FROM unnest(string_to_array(tags, ' ')) t
+            WHERE position(':' in t) > 1) AS keys(k) $$;
+ALTER TABLE items ADD COLUMN IF NOT EXISTS tag_keys text[]
+    GENERATED ALWAYS AS (tagurit_tag_keys(tags)) STORED;
+CREATE INDEX IF NOT EXISTS items_tag_keys ON items USING gin (tag_keys);
+CREATE INDEX IF NOT EXISTS items_title_trgm ON items USING gin (title gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS items_url_trgm ON items USING gin (url gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS items_notes_trgm ON items USING gin (notes gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS items_title_iid ON items (title, iid);
+"""
+'''Indexes for filtering on the server, applied by ensure_search_schema.
+
+tag_keys holds each tag plus the prefix of each prefix:tag, like TagIndex,
+so a tag filter is an indexed @>. pg_trgm indexes serve ~* on the text,
+and (title,iid) pages through the rows by key.'''
+
+PAGE_SIZE = 500
+'''Rows per page when filtering on the server.'''
+
+def escape(s):
+    return s.replace('&','&amp;').replace('<','&lt;').replace('>','&gt;')
+
+def unescape(s):
+    return s.replace('&lt;','<').replace('&gt;','>').replace('&amp;','&')
+
+def guess_title(url):
+    '''Guess a candidate title from a url.'''
+    title = urlparse(url).netloc
+    if title == "github.com":
+        title = urlparse(url).path.split('/')[-1]
+    if title.startswith("www."):
+        title = title[4:]
+    if any([title.endswith(x) for x in (
+        ".com", ".org" ,".net",".gov", ".edu")]):
+        title = title[:-4]
+    return title
+
+def read_config():
+    config = configparser.ConfigParser()
+    config.read([os.path.expanduser('~/.tagurit.ini'), os.path.expanduser('~/.database.ini')])
+    return config
+
+def connect_args(config):
+    return dict(
+            database='tagurit',
+            host=config['tagurit']['host'],
+            user=config['tagurit']['user'],
+            password=config['tagurit']['password'])
+
+def make_bitmap(slots):
+    '''Return an int with bit n set for each n in slots.'''
+    if not slots:
+        return 0
+    buf = bytearray((max(slots) >> 3) + 1)
+    for slot in slots:
+        buf[slot >> 3] |= 1 << (slot & 7)
+    return int.from_bytes(buf, 'little')
+
+def to_bits(bitmap):
+    '''Unpack an int bitmap to bytes so single bits can be tested in O(1).'''
+    return bitmap.to_bytes((bitmap.bit_length() + 7) >> 3, 'little')
+
+def test_bit(bits, slot):
+    i = slot >> 3
+    return i < len(bits) and bool(bits[i] >> (slot & 7) & 1)
+
+def set_bit(buf, slot):
+    '''Set bit slot of bytearray buf in place, growing it as needed.'''
+    i = slot >> 3
+    if i >= len(buf):
+        buf.extend(bytes(i + 1 - len(buf)))
+    buf[i] |= 1 << (slot & 7)
+
+def clear_bit(buf, slot):
+    i = slot >> 3
+    if i < len(buf):
+        buf[i] &= ~(1 << (slot & 7)) & 0xff
+
+class TagIndex:
+    '''Inverted index from tag (and tag prefix) to a bitmap of row slots.
+
+    Every urlstore row gets a slot number when it is added. Each key's
+    bitmap is a bytearray with bit slot set when that row carries the tag,
+    updated in place as rows come and go; match() turns just the keys it
+    needs into ints, so a tag filter is an intersection of ints.'''
+
+    def __init__(self):
+        self.bitmaps = dict()
+        '''tag or tag prefix -> bytearray bitmap of slots'''
+
+        self.sizes = dict()
+        '''tag or tag prefix -> number of rows under it'''
+
+        self.row_keys = dict()
+        '''slot -> set of keys it is indexed under'''
+
+        self.all_rows = bytearray()
+        '''bitmap of every live slot'''
+
+        self.next_slot = 0
+
+    def clear(self):
+        '''Forget every row, but keep handing out fresh slots.'''
+        self.bitmaps.clear()
+        self.sizes.clear()
+        self.row_keys.clear()
+        self.all_rows = bytearray()
+
+    def new_slot(self):
+        slot = self.next_slot
+        self.next_slot += 1
+        return slot
+
+    @staticmethod
+    def tag_keys(tags):
+        '''Return the set of tags plus the prefix of every prefix:tag.'''
+        keys = {x for x in tags.split()}
+        keys |= {x.split(':', 1)[0] for x in keys if ':' in x}
+        return keys
+
+    def add_rows(self, rows):
+        '''Index many (slot,tags) pairs at once, e.g. at load time.'''
+        bitmaps = self.bitmaps
+        sizes = self.sizes
+        for slot, tags in rows:
+            keys = self.tag_keys(tags)
+            self.row_keys[slot] = keys
+            set_bit(self.all_rows, slot)
+            for key in keys:
+                buf = bitmaps.get(key)
+                if buf is None:
+                    buf = bitmaps[key] = bytearray()
+                set_bit(buf, slot)
+                sizes[key] = sizes.get(key, 0) + 1
+
+    def add(self, slot, tags):
+        self.add_rows(((slot, tags),))
+
+    def remove(self, slot):
+        for key in self.row_keys.pop(slot, ()):
+            if self.sizes[key] == 1:
+                del self.bitmaps[key]
+                del self.sizes[key]
+            else:
+                clear_bit(self.bitmaps[key], slot)
+                self.sizes[key] -= 1
+        clear_bit(self.all_rows, slot)
+
+    def update(self, slot, tags):
+        self.remove(slot)
+        self.add(slot, tags)
+
+    def bitmap(self, key):
+        '''Return the bitmap of rows under key as an int.'''
+        buf = self.bitmaps.get(key)
+        return int.from_bytes(buf, 'little') if buf is not None else 0
+
+    def match(self, tagset):
+        '''Return the bitmap of rows whose tags include all of tagset.'''
+        if not tagset:
+            return int.from_bytes(self.all_rows, 'little')
+        if any(tag not in self.sizes for tag in tagset):
+            return 0
+        # the rarest tag first, so the intersection shrinks soonest
+        bitmap = None
+        for tag in sorted(tagset, key=self.sizes.get):
+            other = int.from_bytes(self.bitmaps[tag], 'little')
+            bitmap = other if bitmap is None else bitmap & other
+            if not bitmap:
+                break
+        return bitmap
+
+def fold_tag(tag):
+    '''Return the key under which case, hyphenation and plural variants
+    of a tag collide, e.g. Open-Sources, open_source and opensource.'''
+    prefix, sep, name = tag.lower().replace('-', '').replace('_', '').rpartition(':')
+    if name.endswith('ies') and len(name) > 4:
+        name = name[:-3] + 'y'
+    elif name.endswith(('sses', 'shes', 'ches', 'xes', 'zes')):
+        name = name[:-2]
+    elif name.endswith('s') and not name.endswith('ss') and len(name) > 2:
+        name = name[:-1]
+    return prefix + sep + name
+
+def edit_distance(a, b):
+    '''Edit distance between a and b counting a swap of neighbours as one edit.'''
+    prevprev, prev = None, list(range(len(b) + 1))
+    for i, x in enumerate(a, 1):
+        cur = [i]
+        for j, y in enumerate(b, 1):
+            d = min(prev[j] + 1, cur[j-1] + 1, prev[j-1] + (x != y))
+            if i > 1 and j > 1 and x == b[j-2] and a[i-2] == y:
+                d = min(d, prevprev[j-2] + 1)
+            cur.append(d)
+        prevprev, prev = prev, cur
+    return prev[-1]
+
+class TagTrie:
+    '''Prefix tree from keys to the tags filed under them, for completion.'''
+
+    def __init__(self):
+        self.root = dict()
+        '''char -> child node; the None key holds the set of tags ending here'''
+
+    def add(self, key, tag):
+        node = self.root
+        for c in key:
+            node = node.setdefault(c, dict())
+        node.setdefault(None, set()).add(tag)
+
+    def complete(self, prefix, limit=20):
+        '''Return up to limit tags filed under keys starting with prefix,
+        shortest keys first.'''
+        node = self.root
+        for c in prefix:
+            node = node.get(c)
+            if node is None:
+                return []
+        tags = list()
+        level = [node]
+        while level and len(tags) < limit:
+            following = list()
+            for node in level:
+                tags.extend(sorted(node.get(None, ())))
+                following.extend(node[c] for c in sorted(x for x in node if x is not None))
+            level = following
+        return list(dict.fromkeys(tags))[:limit]
+
+class TypoIndex:
+    '''Words filed under every way of deleting one of their letters.
+
+    Two words one insert, delete, substitution or swap apart share such a
+    key, so typo lookups are a handful of dict probes rather than a walk
+    of the vocabulary.'''
+
+    def __init__(self):
+        self.words = dict()
+        '''deletion key -> set of words'''
+
+    @staticmethod
+    def keys(word):
+        return {word} | {word[:i] + word[i+1:] for i in range(len(word))}
+
+    def add(self, word):
+        for key in self.keys(word):
+            self.words.setdefault(key, set()).add(word)
+
+    def search(self, word):
+        '''Return the words within one edit of word, nearest first.'''
+        found = set()
+        for key in self.keys(word):
+            found.update(self.words.get(key, ()))
+        return sorted(x for x in found if edit_distance(word, x) <= 1)
+
+class TagNormalizer:
+    '''Known tags, indexed to map variants onto them and to suggest and
+    complete them.
+
+    Case, hyphenation and plural variants fold to the same key and are
+    replaced outright. Typos, found with a TypoIndex, and a bare name that
+    exists under a prefix: namespace are only suggested.'''
+
+    def __init__(self):
+        self.tags = set()
+        self.folded = dict()
+        '''fold_tag key -> known tag'''
+
+        self.trie = TagTrie()
+        '''tags by themselves and by the name after their prefix:'''
+
+        self.typos = TypoIndex()
+        self.namespaced = dict()
+        '''name -> set of prefix:name tags'''
+
+    def update(self, tags):
+        for tag in tags:
+            if tag in self.tags:
+                continue
+            self.tags.add(tag)
+            self.folded.setdefault(fold_tag(tag), tag)
+            self.trie.add(tag, tag)
+            self.typos.add(tag)
+            if ':' in tag:
+                name = tag.split(':', 1)[1]
+                self.trie.add(name, tag)
+                self.namespaced.setdefault(name, set()).add(tag)
+
+    def normalize(self, tag):
+        '''Return the known tag that tag is a variant of, else tag lowercased.'''
+        tag = tag.lower()
+        if tag in self.tags:
+            return tag
+        return self.folded.get(fold_tag(tag), tag)
+
+    def suggest(self, tag, limit=3):
+        '''Return known tags that an unknown tag may have been meant as.'''
+        suggestions = sorted(self.namespaced.get(tag, ()))
+        suggestions += [x for x in self.typos.search(tag) if x != tag]
+        return list(dict.fromkeys(suggestions))[:limit]
+
+    def complete(self, prefix, limit=20):
+        return self.trie.complete(prefix.lower(), limit)
+
+class TagFacets:
+    '''Per-tag row counts and a sparse tag co-occurrence table.
+
+    Fed the same keys as TagIndex, so tag prefixes are facets too. Both
+    tables are kept up to date row by row, so drilling down never needs a
+    pass over the urlstore.'''
+
+    def __init__(self):
+        self.counts = dict()
+        '''tag -> rows carrying it'''
+
+        self.cooccur = dict()
+        '''tag -> {other tag -> rows carrying both}'''
+
+    def add(self, keys, n=1):
+        for key in keys:
+            self.counts[key] = self.counts.get(key, 0) + n
+            row = self.cooccur.setdefault(key, dict())
+            for other in keys:
+                if other != key:
+                    row[other] = row.get(other, 0) + n
+        if n < 0:
+            for key in keys:
+                if not self.counts[key]:
+                    del self.counts[key]
+                    del self.cooccur[key]
+                    continue
+                row = self.cooccur[key]
+                for other in keys:
+                    if other in row and not row[other]:
+                        del row[other]
+
+    def remove(self, keys):
+        self.add(keys, -1)
+
+    def within(self, tagset, visible, regex=False):
+        '''Return tag -> number of rows passing the filter that carry it.
+
+        The filter is tagset, plus a regex if regex is true. A filter of at
+        most one tag is answered from the tables; otherwise visible, the
+        counts VisibilityCache kept as it evaluated the rows, is the answer.'''
+        if not regex and not tagset:
+            return dict(self.counts)
+        if not regex and len(tagset) == 1:
+            tag = next(iter(tagset))
+            counts = dict(self.cooccur.get(tag, ()))
+            if tag in self.counts:
+                counts[tag] = self.counts[tag]
+            return counts
+        return dict(visible)
+
+DEFAULT_PORTS = {'http': 80, 'https': 443, 'ftp': 21}
+
+TRACKING_PARAM = re.compile(r'^(utm_\w+|fbclid|gclid|dclid|msclkid|mc_cid|mc_eid|igshid|ref_src)$',
+        re.IGNORECASE)
+
+def canonical_url(url, strip_tracking=False):
+    '''Return url in the form used to detect duplicates.
+
+    Scheme and host are lowercased, a default port and trailing slash are
+    dropped and, if strip_tracking, utm_* style query params are removed.'''
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    netloc = parts.netloc.rpartition('@')
+    host = netloc[2].lower()
+    try:
+        if parts.port is not None and parts.port == DEFAULT_PORTS.get(scheme):
+            host = host.rsplit(':', 1)[0]
+    except ValueError:  # junk after the colon, leave it be
+        pass
+    netloc = netloc[0] + netloc[1] + host
+    query = parts.query
+    if strip_tracking and query:
+        params = parse_qsl(query, keep_blank_values=True)
+        kept = [x for x in params if not TRACKING_PARAM.match(x[0])]
+        if len(kept) != len(params):
+            query = urlencode(kept)
+    return urlunsplit((scheme, netloc, parts.path.rstrip('/'), query, parts.fragment))
+
+def near_url(url):
+    '''Return a looser key than canonical_url that groups near-duplicates.
+
+    Ignores the scheme, a leading www., the fragment, tracking params and
+    case in the path.'''
+    parts = urlsplit(canonical_url(url, strip_tracking=True))
+    netloc = parts.netloc
+    if netloc.startswith('www.'):
+        netloc = netloc[4:]
+    return urlunsplit(('', netloc, parts.path.lower(), parts.query, ''))
+
+class UrlIndex:
+    '''Hash index of row slots by canonical and near-duplicate url.'''
+
+    def __init__(self, strip_tracking=False):
+        self.strip_tracking = strip_tracking
+        self.exact = dict()
+        '''canonical_url -> set of slots'''
+
+        self.near = dict()
+        '''near_url -> set of slots'''
+
+        self.row_urls = dict()
+        '''slot -> url as stored'''
+
+    def clear(self):
+        self.exact.clear()
+        self.near.clear()
+        self.row_urls.clear()
+
+    def keys(self, url):
+        return canonical_url(url, self.strip_tracking), near_url(url)
+
+    def add(self, slot, url):
+        exact, near = self.keys(url)
+        self.exact.setdefault(exact, set()).add(slot)
+        self.near.setdefault(near, set()).add(slot)
+        self.row_urls[slot] = url
+
+    def remove(self, slot):
+        url = self.row_urls.pop(slot, None)
+        if url is None:
+            return
+        for index, key in zip((self.exact, self.near), self.keys(url)):
+            slots = index[key]
+            slots.discard(slot)
+            if not slots:
+                del index[key]
+
+    def update(self, slot, url):
+        self.remove(slot)
+        self.add(slot, url)
+
+    def find(self, url):
+        '''Return the set of slots holding url.'''
+        return self.exact.get(canonical_url(url, self.strip_tracking), set())
+
+    def find_near(self, url):
+        '''Return the urls that are near, but not exact, duplicates of url.'''
+        exact = self.find(url)
+        return [self.row_urls[x] for x in self.near.get(near_url(url), ())
+                if x not in exact]
+
+REGEX_METACHARS = frozenset('.^$*+?{}[]\\|()')
+
+def is_literal(pattern):
+    '''Return True iff pattern has no regex metacharacters.'''
+    return not REGEX_METACHARS.intersection(pattern)
+
+def narrows(old, new):
+    '''Return True if filter new can only match rows that old matched.
+
+    Filters are (tagset,pattern) pairs. A superset of tags narrows. A regex
+    narrows if both are literals and new contains old, or if old is a
+    literal that new extends without quantifying its last char or adding
+    an alternation. Anything else is assumed not to narrow.'''
+    old_tagset, old_pattern = old
+    new_tagset, new_pattern = new
+    if not old_tagset <= new_tagset:
+        return False
+    if not old_pattern or old_pattern == new_pattern:
+        return True
+    if not is_literal(old_pattern):
+        return False
+    old_pattern, new_pattern = old_pattern.lower(), new_pattern.lower()
+    if is_literal(new_pattern):
+        return old_pattern in new_pattern
+    return new_pattern.startswith(old_pattern) \
+            and new_pattern[len(old_pattern)] not in '*+?{' \
+            and '|' not in new_pattern
+
+WORD = re.compile(r'\w+')
+
+def trigrams(word):
+    return {word[i:i+3] for i in range(len(word) - 2)}
+
+def text_query(pattern):
+    '''Break a regex into (word,how) terms TextIndex can answer, or None.
+
+    Only literals are handled, optionally with \\b at either end. how says
+    whether a matching token must equal the word, start or end with it, or
+    merely contain it, depending on what bounds the word in the pattern.'''
+    lead = pattern.startswith('\\b')
+    if lead:
+        pattern = pattern[2:]
+    trail = pattern.endswith('\\b')
+    if trail:
+        pattern = pattern[:-2]
+    if not pattern or not is_literal(pattern):
+        return None
+    pattern = pattern.lower()
+    terms = list()
+    for m in WORD.finditer(pattern):
+        left = m.start() > 0 or lead
+        right = m.end() < len(pattern) or trail
+        terms.append((m.group(), ('in', 'suffix', 'prefix', 'exact')[left * 2 + right]))
+    return terms or None
+
+class TextIndex:
+    '''Inverted index from words in title, url and notes to row slots.
+
+    Every \\w+ token (so url hosts and path segments too) has a posting
+    array of slots, and trigrams of the tokens map to the tokens holding
+    them, so a substring is found without scanning the vocabulary.
+    Postings are only appended to: a slot may linger under words it no
+    longer has, so candidates() is a superset for the caller to confirm
+    with the real regex, and rebuild() sweeps the stale entries out.'''
+
+    def __init__(self):
+        self.postings = dict()
+        '''token -> array of slots'''
+
+        self.grams = dict()
+        '''trigram -> set of tokens containing it'''
+
+        self.live = 0
+        self.stale = 0
+
+    def add(self, slot, *texts):
+        for token in set(WORD.findall(' '.join(texts).lower())):
+            postings = self.postings.get(token)
+            if postings is None:
+                postings = self.postings[token] = array('I')
+                for gram in trigrams(token):
+                    self.grams.setdefault(gram, set()).add(token)
+            postings.append(slot)
+        self.live += 1
+
+    def remove(self, slot):
+        self.live -= 1
+        self.stale += 1
+
+    def update(self, slot, *texts):
+        self.remove(slot)
+        self.add(slot, *texts)
+
+    def needs_rebuild(self):
+        return self.stale > max(self.live, 1000)
+
+    def rebuild(self, rows):
+        '''Reindex from scratch given (slot,texts) pairs.'''
+        self.__init__()
+        for slot, texts in rows:
+            self.add(slot, *texts)
+
+    def tokens(self, word, how):
+        if how == 'exact':
+            return [word] if word in self.postings else []
+        tokens = None
+        for gram in sorted(trigrams(word), key=lambda x: len(self.grams.get(x, ()))):
+            tokens = self.grams.get(gram, set()) if tokens is None \
+                    else tokens & self.grams.get(gram, set())
+            if not tokens:
+                return []
+        if tokens is None:  # too short for trigrams
+            tokens = self.postings.keys()
+        if how == 'prefix':
+            return [x for x in tokens if x.startswith(word)]
+        if how == 'suffix':
+            return [x for x in tokens if x.endswith(word)]
+        return [x for x in tokens if word in x]
+
+    def candidates(self, pattern):
+        '''Return a set of slots including every row pattern can match,
+        or None if pattern is not something the index can answer.'''
+        terms = text_query(pattern)
+        if terms is None:
+            return None
+        result = None
+        for word, how in terms:
+            slots = set()
+            for token in self.tokens(word, how):
+                slots.update(self.postings[token])
+            result = slots if result is None else result & slots
+            if not result:
+                break
+        return result
+
+class VisibilityCache:
+    '''Per-row visibility, computed at most once per filter generation.
+
+    The Gtk.TreeModelFilter visible func and the status line count both
+    read from here, and the count is kept as a running total as rows are
+    evaluated, so a refilter runs the predicate once per row. When row_keys
+    is set, the tag facets of the visible rows are kept the same way.'''
+
+    def __init__(self):
+        self.generation = 0
+        self.count = 0
+        self.evaluated = bytearray()
+        self.visible = bytearray()
+
+        self.row_keys = None
+        '''slot -> tag keys, TagIndex.row_keys, or None not to count facets'''
+
+        self.facets = dict()
+        '''tag key -> visible rows carrying it'''
+
+    def reset(self, nslots=0):
+        '''Start a new filter generation, forgetting every result.'''
+        self.generation += 1
+        self.count = 0
+        self.facets = dict()
+        self.evaluated = bytearray((nslots >> 3) + 1)
+        self.visible = bytearray(len(self.evaluated))
+
+    def narrow(self):
+        '''Start a new generation for a filter that narrows the last one.
+
+        Rows known to be hidden stay hidden without being re-tested; only
+        the visible rows, and rows never evaluated, are tested again.'''
+        self.generation += 1
+        self.count = 0
+        self.facets = dict()
+        n = len(self.evaluated)
+        hidden = int.from_bytes(self.evaluated, 'little') \
+                & ~int.from_bytes(self.visible, 'little')
+        self.evaluated = bytearray(hidden.to_bytes(n, 'little'))
+        self.visible = bytearray(n)
+
+    def lookup(self, slot):
+        '''Return the cached visibility of slot, or None if not yet known.'''
+        i, bit = slot >> 3, 1 << (slot & 7)
+        if i >= len(self.evaluated) or not self.evaluated[i] & bit:
+            return None
+        return bool(self.visible[i] & bit)
+
+    def store(self, slot, visible):
+        i, bit = slot >> 3, 1 << (slot & 7)
+        if i >= len(self.evaluated):
+            grow = i + 1 - len(self.evaluated)
+            self.evaluated.extend(bytes(grow))
+            self.visible.extend(bytes(grow))
+        self.forget(slot)
+        self.evaluated[i] |= bit
+        if visible:
+            self.visible[i] |= bit
+            self.count += 1
+            if self.row_keys is not None:
+                facets = self.facets
+                for key in self.row_keys[slot]:
+                    facets[key] = facets.get(key, 0) + 1
+
+    def forget(self, slot):
+        '''Drop the cached result for a row that changed or went away.
+
+        Call this before the row's tag keys change.'''
+        i, bit = slot >> 3, 1 << (slot & 7)
+        if i >= len(self.evaluated):
+            return
+        if self.evaluated[i] & self.visible[i] & bit:
+            self.count -= 1
+            if self.row_keys is not None:
+                facets = self.facets
+                for key in self.row_keys[slot]:
+                    if facets[key] == 1:
+                        del facets[key]
+                    else:
+                        facets[key] -= 1
+        self.evaluated[i] &= ~bit
+        self.visible[i] &= ~bit
+
+class ItemModel:
+    '''Items and the indexes behind TagURIt's filters, duplicate checks and tags.
+
+    This is everything the window knows about its rows apart from the
+    Gtk.ListStore showing them, so it can be loaded, filtered and timed
+    without a display or a database. Rows are identified by slot.'''
+
+    def __init__(self, strip_tracking=False):
+        self.visible_tagset = None
+        '''A item is visible when its tags match all of these.'''
+
+        self.regex = None
+        '''A item is visible if title or url match this regex.'''
+
+        self.visibility = VisibilityCache()
+        '''Visibility of each row under the current filters.'''
+
+        self.filter_state = (frozenset(), '')
+        '''(tagset,pattern) the visibility cache was last computed for.'''
+
+        self.tag_index = TagIndex()
+        '''Bitmaps of rows by tag, see TagIndex.'''
+
+        self.tag_bits = None
+        '''Unpacked bitmap of rows matching visible_tagset.'''
+
+        self.text_index = TextIndex()
+        '''Words in title, url and notes, see TextIndex.'''
+
+        self.text_bits = None
+        '''Unpacked bitmap of rows regex might match, None to test them all.'''
+
+        self.dirty = set()
+        '''Slots added or changed since tag_bits and text_bits were computed.'''
+
+        self.item_text = dict()
+        '''slot -> (title,url,notes) as in urlstore, for the regex filter.'''
+
+        self.tag_normalizer = TagNormalizer()
+        '''Known tags indexed for variants, typos and completion.'''
+
+        self.known_tagset = self.tag_normalizer.tags
+        '''Complete set of known tags, only add to it with learn_tags.'''
+
+        self.facets = TagFacets()
+        '''Tag counts and co-occurrence for drilling down.'''
+
+        self.facet_counts = None
+        '''tag -> count among the rows passing the filter, None if unfiltered.'''
+
+        self.url_index = UrlIndex(strip_tracking)
+        '''Slots by normalized url for duplicate checks.'''
+
+        self.slot_by_iid = dict()
+        '''iid -> slot, for applying server side changes.'''
+
+    def __len__(self):
+        return len(self.item_text)
+
+    def clear(self, reuse_slots=False):
+        '''Drop every row.
+
+        Slots start again from 0 if reuse_slots, which is only safe once
+        nothing outside the model still refers to the old ones.'''
+        self.tag_index.clear()
+        if reuse_slots:
+            self.tag_index.next_slot = 0
+        self.facets = TagFacets()
+        self.url_index.clear()
+        self.item_text.clear()
+        self.text_index = TextIndex()
+        self.slot_by_iid.clear()
+        self.dirty.clear()
+        self.visibility.reset()
+
+    def add_rows(self, rows):
+        '''Index database rows; return them as urlstore rows with their slots.'''
+        items = list()
+        for iid,title,url,notes,tags in rows:
+            #tooltips use pango markup so you must escape &, <, >, etc
+            notes = escape(notes)
+            # tags in database are surrounded by spaces for easy sql matching
+            tags = tags.strip()
+            slot = self.tag_index.new_slot()
+            items.append((iid,title,url,notes,tags,slot))
+            self.url_index.add(slot,url)
+            self.item_text[slot] = (title,url,notes)
+            self.text_index.add(slot,title,url,notes)
+            if iid:     # 0 until a queued insert is written
+                self.slot_by_iid[iid] = slot
+            self.learn_tags(tags.split())
+        self.tag_index.add_rows((x[5],x[4]) for x in items)
+        for item in items:
+            self.facets.add(self.tag_index.row_keys[item[5]])
+        self.mark_dirty(x[5] for x in items)
+        return items
+
+    def update_row(self, slot, title, url, notes, tags):
+        '''Reindex a changed row; return its (title,url,notes,tags) urlstore columns.'''
+        #tooltips use pango markup so you must escape &, <, >, etc
+        notes = escape(notes)
+        tags = tags.strip()
+        self.visibility.forget(slot)
+        self.facets.remove(self.tag_index.row_keys[slot])
+        self.tag_index.update(slot,tags)
+        self.facets.add(self.tag_index.row_keys[slot])
+        self.url_index.update(slot,url)
+        self.item_text[slot] = (title,url,notes)
+        self.text_index.update(slot,title,url,notes)
+        self.learn_tags(tags.split())
+        self.mark_dirty((slot,))
+        return (title,url,notes,tags)
+
+    def remove_row(self, slot, iid):
+        '''Drop a row from the indexes.'''
+        self.visibility.forget(slot)
+        self.facets.remove(self.tag_index.row_keys[slot])
+        self.tag_index.remove(slot)
+        self.url_index.remove(slot)
+        del self.item_text[slot]
+        self.text_index.remove(slot)
+        if self.slot_by_iid.get(iid) == slot:
+            del self.slot_by_iid[iid]
+        self.dirty.discard(slot)
+
+    def set_iid(self, slot, iid):
+        '''Note the iid a queued insert was given.'''
+        self.slot_by_iid[iid] = slot
+
+    def mark_dirty(self, slots):
+        '''Have the filters test slots directly rather than through the bits.
+
+        Once a good share of the rows are dirty, the bits are recomputed.'''
+        self.dirty.update(slots)
+        if len(self.dirty) > max(len(self) >> 3, 1000):
+            self.refresh_filter_bits()
+
+    def refresh_filter_bits(self):
+        '''Recompute the rows the filters can match from the tag and text indexes.'''
+        self.dirty.clear()
+        if self.visible_tagset:
+            self.tag_bits = to_bits(self.tag_index.match(self.visible_tagset))
+        else:
+            self.tag_bits = None
+        slots = None
+        if self.regex:
+            if self.text_index.needs_rebuild():
+                self.text_index.rebuild(self.item_text.items())
+            slots = self.text_index.candidates(self.regex.pattern)
+        self.text_bits = None if slots is None else to_bits(make_bitmap(slots))
+
+    def set_filter(self, tags, pattern):
+        '''Filter on tags, a string of space separated tags, and pattern.
+
+        Raises re.error for a bad pattern. Rows are then evaluated lazily
+        by is_visible.'''
+        regex = re.compile(pattern,flags=re.IGNORECASE) if pattern else None
+        self.regex = regex
+        self.visible_tagset = {x for x in tags.split()}
+        self.refresh_filter_bits()
+        state = (frozenset(self.visible_tagset), pattern)
+        # facets the tables can't answer are counted as rows are evaluated
+        if regex or len(self.visible_tagset) > 1:
+            self.visibility.row_keys = self.tag_index.row_keys
+        else:
+            self.visibility.row_keys = None
+        if narrows(self.filter_state, state):
+            self.visibility.narrow()    #only re-test the visible rows
+        else:
+            self.visibility.reset(self.tag_index.next_slot)
+        self.filter_state = state
+
+    def is_visible(self, slot):
+        '''Return whether slot passes the filters, evaluating it at most once.'''
+        visible = self.visibility.lookup(slot)
+        if visible is None:
+            visible = self.evaluate_item(slot)
+            self.visibility.store(slot,visible)
+        return visible
+
+    def evaluate_item(self, slot):
+        '''Apply the tag and regex filters to one row.'''
+        title,url,notes = self.item_text[slot]
+        if slot in self.dirty:  # changed since the bits were computed
+            if self.visible_tagset and not self.visible_tagset <= self.tag_index.row_keys[slot]:
+                return False
+        else:
+            if self.tag_bits is not None and not test_bit(self.tag_bits,slot):
+                return False
+            # only rows the text index can't rule out need the regex
+            if self.text_bits is not None and not test_bit(self.text_bits,slot):
+                return False
+        if self.regex:
+            if not self.regex.search(title) \
+                    and not self.regex.search(url) \
+                    and not self.regex.search(notes) :
+                return False
+        return True
+
+    def finish_filter(self):
+        '''Once every row is evaluated, count tags among the visible ones.'''
+        if self.visible_tagset or self.regex:
+            self.facet_counts = self.facets.within(self.visible_tagset,
+                    self.visibility.facets,self.regex is not None)
+        else:
+            self.facet_counts = None
+
+    def count_visible_items(self):
+        return self.visibility.count
+
+    def describe_facets(self, top=5):
+        '''Return the tags most common among the filtered rows, for the status line.'''
+        if not self.facet_counts:
+            return ""
+        counts = [(n,tag) for tag,n in self.facet_counts.items()
+                if tag not in self.visible_tagset]
+        counts.sort(key=lambda x: (-x[0],x[1]))
+        if not counts:
+            return ""
+        return "; also tagged " + ", ".join(
+                "{0} {1}".format(tag,n) for n,tag in counts[:top])
+
+    def is_duplicate_url(self, url):
+        '''Return True iff url is already among the rows.'''
+        return bool(self.url_index.find(url))
+
+    def learn_tags(self, tags):
+        self.tag_normalizer.update(tags)
+
+    def normalize_tags(self, tags):
+        '''Replace "new" tags that are variants of existing ones with the existing tag.
+
+        Returns the tags and a note suggesting known tags for any still novel.'''
+        tagset = set()
+        suggestions = list()
+        for tag in tags.split():
+            fixed = self.tag_normalizer.normalize(tag)
+            if fixed != tag:
+                print("converting {0} to {1}".format(tag,fixed))
+            elif tag not in self.known_tagset:
+                maybe = self.tag_normalizer.suggest(tag)
+                if maybe:
+                    suggestions.append("{0}: {1}?".format(tag," or ".join(maybe)))
+            tagset.add(fixed)
+        note = "New tags, did you mean " + "; ".join(suggestions) if suggestions else ""
+        return ' '.join(tagset), note
+
+def ensure_delta_schema(conn):
+    '''Add the updated_at column, deletion log and url index if missing.
+
+    Returns False if the schema could not be brought up to date.'''
+    import psycopg2     # only here, so the model imports without it
+    cur = conn.cursor()
+    cur.execute("""SELECT to_regclass('deleted_items') IS NOT NULL
+                   AND to_regclass('items_url_key') IS NOT NULL AND EXISTS (
+                       SELECT 1 FROM information_schema.columns
+                       WHERE table_name = 'items' AND column_name = 'updated_at');""")
+    if cur.fetchone()[0]:
+        return True
+    try:
+        cur.execute(DELTA_SCHEMA)   # one implicit transaction
+    except psycopg2.Error as e:
+        print("delta sync disabled: {0}".format(e))
+        return False
+    return True
+
+def ensure_search_schema(conn):
+    '''Add the tag_keys column and GIN indexes server_filter needs, if missing.
+
+    Returns False if the schema could not be brought up to date.'''
+    import psycopg2     # see ensure_delta_schema
+    cur = conn.cursor()
+    cur.execute("""SELECT to_regclass('items_title_iid') IS NOT NULL AND EXISTS (
+                       SELECT 1 FROM information_schema.columns
+                       WHERE table_name = 'items' AND column_name = 'tag_keys');""")
+    if cur.fetchone()[0]:
+        return True
+    try:
+        cur.execute(SEARCH_SCHEMA)  # one implicit transaction
+    except psycopg2.Error as e:
+        print("server side filtering disabled: {0}".format(e))
+        return False
+    return True
+
+def open_snapshot(path):
+    '''Return (cursor over the snapshot rows, updated_hwm, deleted_hwm), or None.
+
+    The high-water marks are the server's max(updated_at) and
+    max(deleted_items.did) when the snapshot was taken.'''
+    if not os.path.exists(path):
+        return None
+    try:
+        db = sqlite3.connect(path)
+        meta = dict(db.execute("""SELECT key,value FROM meta;"""))
+        cur = db.execute("""SELECT iid,title,url,notes,tags FROM items ORDER BY ord;""")
+        return cur, meta['updated_hwm'], int(meta['deleted_hwm'])
+    except (sqlite3.Error, KeyError, ValueError) as e:
+        print("ignoring snapshot {0}: {1}".format(path,e))
+        return None
+
+def write_snapshot(path, rows, updated_hwm, deleted_hwm):
+    '''Atomically replace the snapshot at path with rows in display order.'''
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    os.close(fd)
+    try:
+        db = sqlite3.connect(tmp)
+        db.execute("""CREATE TABLE items (ord INTEGER PRIMARY KEY,
+                      iid INTEGER, title TEXT, url TEXT, notes TEXT, tags TEXT);""")
+        db.execute("""CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);""")
+        db.executemany("""INSERT INTO items VALUES (?,?,?,?,?,?);""",
+                ((n,) + tuple(row) for n, row in enumerate(rows)))
+        db.executemany("""INSERT INTO meta VALUES (?,?);""",
+                (('updated_hwm', updated_hwm), ('deleted_hwm', str(deleted_hwm))))
+        db.commit()
+        db.close()
+        os.replace(tmp, path)
+    except:
+        os.unlink(tmp)
+        raise
+
+class Instruments:
+    '''Time named phases, keeping a rolling window of samples for each.
+
+    Phases recorded since the last begin() make up the last operation,
+    for showing on the status line. With trace set every phase is also
+    kept as a Chrome trace event, see write_trace. Phases may be
+    recorded from any thread.'''
+
+    def __init__(self, window=256, trace=False):
+        self.samples = dict()
+        '''phase -> deque of the latest window durations in seconds'''
+
+        self.window = window
+        self.last = dict()
+        '''phase -> total seconds within the current operation'''
+
+        self.events = list() if trace else None
+        self.epoch = time.perf_counter()
+
+    def begin(self):
+        '''Start a new operation, forgetting the last one's timings.'''
+        self.last = dict()
+
+    @contextmanager
+    def phase(self, name, **args):
+        '''Time the with block as one sample of phase name.'''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, start, time.perf_counter(), args)
+
+    def record(self, name, start, end, args=None):
+        '''Add a sample of phase name that ran from start to end (perf_counter).'''
+        samples = self.samples.get(name)
+        if samples is None:
+            samples = self.samples.setdefault(name, deque(maxlen=self.window))
+        samples.append(end - start)
+        self.last[name] = self.last.get(name, 0) + end - start
+        if self.events is not None:
+            self.events.append(dict(name=name, ph='X', pid=os.getpid(),
+                    tid=threading.get_ident(), ts=(start - self.epoch) * 1e6,
+                    dur=(end - start) * 1e6, args=args or {}))
+
+    def describe_last(self):
+        '''Return the last operation's phases and times, e.g. "refilter 12.0ms".'''
+        return ", ".join("{0} {1:.1f}ms".format(name, seconds * 1000)
+                for name, seconds in list(self.last.items()))
+
+    def percentiles(self, name, points=(50, 90, 99)):
+        '''Return the given percentiles of phase name's recent samples, in seconds.'''
+        samples = sorted(self.samples.get(name, ()))
+        if not samples:
+            return [None] * len(points)
+        return [samples[min(len(samples) - 1, len(samples) * x // 100)] for x in points]
+
+    def histogram(self, name):
+        '''Return [(upper bound ms, count)] of phase name's recent samples.
+
+        Buckets double from 1ms, so the spread of a phase's times shows
+        up without having to choose bucket sizes for each.'''
+        counts = dict()
+        for seconds in list(self.samples.get(name, ())):
+            bound = 1
+            while bound < seconds * 1000:
+                bound *= 2
+            counts[bound] = counts.get(bound, 0) + 1
+        return sorted(counts.items())
+
+    def summary(self):
+        '''Return a line per phase with its sample count and percentiles.'''
+        lines = list()
+        for name in sorted(self.samples):
+            p50, p90, p99 = self.percentiles(name)
+            lines.append("{0:<12} n={1:<4} p50 {2:8.1f}ms  p90 {3:8.1f}ms  p99 {4:8.1f}ms  {5}".format(
+                    name, len(self.samples[name]), p50 * 1000, p90 * 1000, p99 * 1000,
+                    " ".join("<{0}ms:{1}".format(*x) for x in self.histogram(name))))
+        return lines
+
+    def write_trace(self, path):
+        '''Write the recorded phases as Chrome trace JSON, for chrome://tracing or Perfetto.'''
+        with open(path, 'w') as fh:
+            json.dump(dict(traceEvents=self.events or [], displayTimeUnit='ms'), fh)
+
+WriteOp = namedtuple('WriteOp', 'kind slot iid values undo')
+'''A queued database write.
+
+kind is insert, update or delete; slot is the urlstore row; iid is 0 while
+the row's insert is still queued; values are (title,url,notes,tags) as
+stored in the database; undo is the (iid,title,url,notes,tags) the row had
+before the write, or None for an insert.'''
+
+def coalesce(ops):
+    '''Merge queued writes to the same row, keeping the earliest undo.'''
+    merged = dict()
+    for op in ops:
+        prev = merged.get(op.slot)
+        if prev is None or prev.kind == 'delete':
+            merged[op.slot] = op
+        elif prev.kind == 'insert':
+            if op.kind == 'delete':
+                del merged[op.slot]     # never reached the database
+            else:
+                merged[op.slot] = prev._replace(values=op.values)
+        else:
+            merged[op.slot] = op._replace(undo=prev.undo)
+    return list(merged.values())
+
+class WriteBehind:
+    '''Apply database writes on a worker thread that owns its own connection.
+
+    Writes queued within linger seconds of each other are coalesced and
+    applied in a single transaction. Results come back through post, which
+    should run a callback on the GUI thread (GLib.idle_add): on_inserted
+    gets [(slot,iid)] for new rows, on_failed gets the ops of a batch that
+    was rolled back and the error message. Each batch is timed as a
+    db_write phase of instruments, if given.
+
+    Writes refer to rows by slot, so slots may only be reused while idle().'''
+
+    def __init__(self, connect, post, on_inserted, on_failed, linger=0.05, instruments=None):
+        self.connect = connect
+        self.instruments = instruments
+        self.post = post
+        self.on_inserted = on_inserted
+        self.on_failed = on_failed
+        self.linger = linger
+        self.queue = queue.Queue()
+        self.pending = 0
+        '''Writes put but not yet done with, counted on the GUI thread.'''
+
+        self.iids = dict()
+        '''slot -> iid of rows the worker inserted'''
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def put(self, kind, slot, iid, values=None, undo=None):
+        self.pending += 1
+        self.queue.put(WriteOp(kind, slot, iid, values, undo))
+
+    def done(self, count):
+        self.pending -= count
+
+    def idle(self):
+        '''Return True iff every write and its callbacks have run.'''
+        return self.pending == 0
+
+    def forget_slots(self):
+        '''Drop the worker's slot -> iid map before slots are reused.
+
+        Only call this while idle(), when the worker is waiting for work.'''
+        self.iids.clear()
+
+    def close(self, timeout=10):
+        '''Flush queued writes and stop the worker.'''
+        self.queue.put(None)
+        self.thread.join(timeout)
+
+    def run(self):
+        conn = None
+        iids = self.iids
+        closing = False
+        while not closing:
+            ops = [self.queue.get()]
+            time.sleep(self.linger)
+            while True:
+                try:
+                    ops.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            closing = None in ops
+            ops = [x for x in ops if x is not None]
+            count = len(ops)
+            ops = coalesce(ops)
+            if not ops:
+                if count:
+                    self.post(self.done, count)
+                continue
+            try:
+                if conn is None or conn.closed:
+                    conn = self.connect()
+                if self.instruments:
+                    with self.instruments.phase('db_write', ops=len(ops)):
+                        self.apply(conn, ops, iids)
+                else:
+                    self.apply(conn, ops, iids)
+            except Exception as e:  # whatever the driver raises, keep the worker alive
+                ops = [x._replace(iid=x.iid or iids.get(x.slot, 0)) for x in ops]
+                self.post(self.on_failed, ops, str(e).strip())
+            # after the results, which post runs in order
+            self.post(self.done, count)
+        if conn is not None:
+            conn.close()
+
+    def apply(self, conn, ops, iids):
+        inserted = list()
+        with conn:  # one transaction, rolled back on error
+            cur = conn.cursor()
+            for op in ops:
+                iid = op.iid or iids.get(op.slot)
+                if op.kind == 'insert':
+                    cur.execute(
+                            """INSERT INTO items (title,url,notes,tags) VALUES
+                            (%s,%s,%s,%s) RETURNING iid;""",
+                            op.values)
+                    inserted.append((op.slot, cur.fetchone()[0]))
+                elif not iid:
+                    continue    # its insert failed and was already undone
+                elif op.kind == 'update':
+                    cur.execute(
+                            """UPDATE items
+                               SET title = %s,url = %s,notes = %s,tags = %s
+                               WHERE iid = %s;""",
+                            op.values + (iid,))
+                else:
+                    cur.execute("""DELETE FROM items WHERE iid = %s;""",(iid,))
+        iids.update(inserted)
+        if inserted:
+            self.post(self.on_inserted, inserted)
+
+class NetscapeParser(HTMLParser):
+    '''Collect (title,url,notes,tags) from a Netscape bookmark file.'''
+
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.records = list()
+        self.title = None
+        self.notes = None
+
+    def end_notes(self):
+        if self.notes is not None:
+            self.records[-1][2] = ''.join(self.notes).strip()
+            self.notes = None
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == 'a' and attrs.get('href'):
+            self.end_notes()
+            tags = [x.strip().replace(' ', '-') for x in (attrs.get('tags') or '').split(',')]
+            self.records.append(['', attrs['href'], '', [x for x in tags if x]])
+            self.title = list()
+        elif tag == 'dd' and self.records:
+            self.notes = list()
+        elif tag in ('dt', 'dl', 'h3'):
+            self.end_notes()
+
+    def handle_endtag(self, tag):
+        if tag == 'a' and self.title is not None:
+            self.records[-1][0] = ''.join(self.title).strip()
+            self.title = None
+        elif tag == 'dl':
+            self.end_notes()
+
+    def handle_data(self, data):
+        if self.title is not None:
+            self.title.append(data)
+        elif self.notes is not None:
+            self.notes.append(data)
+
+def split_tags(tags):
+    return tags.split() if isinstance(tags, str) else list(tags or ())
+
+def read_items(fh, fmt):
+    '''Return (title,url,notes,[tags]) records read from fh in format fmt.'''
+    if fmt == 'html':
+        parser = NetscapeParser()
+        parser.feed(fh.read())
+        parser.close()
+        parser.end_notes()
+        return [tuple(x) for x in parser.records]
+    if fmt == 'json':
+        items = json.load(fh)
+    else:
+        items = csv.DictReader(fh)
+    return [(x.get('title') or '', x.get('url') or '', x.get('notes') or '',
+             split_tags(x.get('tags'))) for x in items]
+
+class ItemWriter:
+    '''Write (title,url,notes,tags) database rows to fh in format fmt, a
+    batch at a time: write() each batch, then finish().'''
+
+    def __init__(self, fh, fmt):
+        self.fh = fh
+        self.fmt = fmt
+        self.count = 0
+        if fmt == 'html':
+            fh.write('<!DOCTYPE NETSCAPE-Bookmark-file-1>\n'
+                     '<META HTTP-EQUIV="Content-Type" CONTENT="text/html; charset=UTF-8">\n'
+                     '<TITLE>Bookmarks</TITLE>\n<H1>Bookmarks</H1>\n<DL><p>\n')
+        elif fmt == 'json':
+            # one object per line, so the whole list never has to be in memory
+            fh.write('[')
+        else:
+            self.csv = csv.writer(fh)
+            self.csv.writerow(('title', 'url', 'notes', 'tags'))
+
+    def write(self, rows):
+        fh = self.fh
+        if self.fmt == 'html':
+            for title,url,notes,tags in rows:
+                fh.write('    <DT><A HREF="{0}" TAGS="{1}">{2}</A>\n'.format(
+                        html.escape(url), html.escape(','.join(tags.split())), html.escape(title)))
+                if notes:
+                    fh.write('    <DD>{0}\n'.format(html.escape(notes)))
+        elif self.fmt == 'json':
+            for title,url,notes,tags in rows:
+                fh.write(',\n' if self.count else '\n')
+                json.dump(dict(title=title, url=url, notes=notes, tags=tags.split()), fh)
+                self.count += 1
+        else:
+            self.csv.writerows((title,url,notes,tags.strip()) for title,url,notes,tags in rows)
+
+    def finish(self):
+        if self.fmt == 'html':
+            self.fh.write('</DL><p>\n')
+        elif self.fmt == 'json':
+            self.fh.write('\n]\n')
+
+def write_items(fh, fmt, rows):
+    '''Write (title,url,notes,tags) database rows to fh in format fmt.'''
+    out = ItemWriter(fh, fmt)
+    out.write(rows)
+    out.finish()
+
+def import_items(conn, records, strip_tracking=False, dry_run=False):
+    '''Bulk insert records with one COPY, skipping urls already stored.
+
+    Existing urls and tags are read in one query each; new tags are
+    normalized against the existing ones. Returns (added, skipped).'''
+    cur = conn.cursor()
+    cur.execute("""SELECT url FROM items;""")
+    seen = {canonical_url(x, strip_tracking) for (x,) in cur}
+    cur.execute("""SELECT DISTINCT unnest(string_to_array(btrim(tags),' ')) FROM items;""")
+    normalizer = TagNormalizer()
+    normalizer.update(x for (x,) in cur if x)
+    buf = io.StringIO()
+    out = csv.writer(buf)
+    added = skipped = 0
+    for title,url,notes,tags in records:
+        url = url.strip().rstrip('/')
+        key = canonical_url(url, strip_tracking)
+        if not url or key in seen:
+            skipped += 1
+            continue
+        seen.add(key)
+        tagset = {normalizer.normalize(x) for x in tags}
+        normalizer.update(tagset)
+        # tags in database are surrounded by spaces for easy sql matching
+        out.writerow((title.strip() or guess_title(url), url, notes.strip(),
+                ' ' + ' '.join(sorted(tagset)) + ' '))
+        added += 1
+    if not dry_run:
+        buf.seek(0)
+        cur.copy_expert("""COPY items (title,url,notes,tags) FROM STDIN WITH (FORMAT csv);""", buf)
+        conn.commit()
+    return added, skipped
+